@@ -0,0 +1,659 @@
+# -*- coding: utf-8 -*-
+''' Non-blocking Client running on a tornado IOLoop.
+
+AsyncClient reuses every request-building method of Client and only
+replaces the transport, so each call returns a future (yield it in a
+tornado coroutine, or await it where the IOLoop runs on asyncio) and
+thousands of calls can share one loop. Install pycurl and configure
+tornado.curl_httpclient.CurlAsyncHTTPClient to keep connections alive.
+'''
+
+import os
+import json
+import time
+import errno
+import socket
+import urllib
+import urlparse
+
+import requests
+from tornado import gen
+from tornado.locks import Semaphore
+from tornado.queues import Queue
+from tornado.ioloop import IOLoop
+from tornado.concurrent import Future
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPError
+
+from baidu import throttle
+from baidu.pcs import Client, BlockBody, UploadError, DownloadError, \
+    ListError
+from baidu.thumbcache import file_version
+
+
+def _urlencode(params):
+    return urllib.urlencode(dict(
+        (k, v.encode('utf-8') if isinstance(v, unicode) else v)
+        for k, v in params.items()))
+
+
+# socket errors of a connection that was never made
+UNSENT_ERRNOS = (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH)
+
+
+def _retry_error(error):
+    # the requests exception a RetryPolicy judges a tornado error by
+    if isinstance(error, socket.gaierror) or (
+            isinstance(error, socket.error) and error.errno in UNSENT_ERRNOS):
+        return requests.exceptions.ConnectTimeout(error)
+    message = str(error)
+    if 'while connecting' in message or 'in request queue' in message:
+        return requests.exceptions.ConnectTimeout(error)
+    if 'Timeout' in message:
+        return requests.exceptions.ReadTimeout(error)
+    return requests.exceptions.ConnectionError(error)
+
+
+class _Reply(object):
+    # the parts of a requests.Response a RetryPolicy looks at
+
+    def __init__(self, response):
+        self.status_code = response.code
+        self.body = response.body
+
+    def json(self):
+        return json.loads(self.body or '')
+
+
+class BodyStream(object):
+    ''' Body of a stream=True reply of AsyncClient: each yield read()
+    returns the next chunk, and None once the body is complete.
+
+    Chunks are queued as they arrive, since tornado cannot pause the
+    connection, so a reader slower than the network buffers the rest.
+    '''
+
+    def __init__(self):
+        self.chunks = Queue()
+        self.received = 0
+
+    def _put(self, chunk):
+        self.received += len(chunk)
+        self.chunks.put_nowait(chunk)
+
+    @gen.coroutine
+    def read(self):
+        chunk = yield self.chunks.get()
+        if isinstance(chunk, Exception):
+            raise chunk
+        raise gen.Return(chunk)
+
+
+class AsyncClient(Client):
+
+    def __init__(self, access_token, max_clients=100, connect_timeout=20,
+                 request_timeout=3600, **kwargs):
+        super(AsyncClient, self).__init__(access_token, **kwargs)
+        self.http = AsyncHTTPClient(force_instance=True,
+                                    max_clients=max_clients)
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+
+    def close(self):
+        self.http.close()
+        super(AsyncClient, self).close()
+
+    def _http_request(self, method, url, params=None, data=None,
+                      headers=None, streaming_callback=None,
+                      header_callback=None, throttles=()):
+        headers = dict(headers or {})
+        body = body_producer = None
+        if params:
+            url += '?' + _urlencode(params)
+        if isinstance(data, BlockBody):
+            headers['Content-Length'] = str(len(data))
+            body_producer = self._body_producer(data, throttles)
+        elif data is not None:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            body = _urlencode(data)
+        elif method == 'POST':
+            body = ''
+        return HTTPRequest(url, method,
+                           headers=headers,
+                           body=body,
+                           body_producer=body_producer,
+                           streaming_callback=streaming_callback,
+                           header_callback=header_callback,
+                           connect_timeout=self.connect_timeout,
+                           request_timeout=self.request_timeout)
+
+    def _body_producer(self, body, throttles):
+        size = 64 * 1024
+        if any(t.rate for t in throttles):
+            size = throttle.QUANTUM
+
+        @gen.coroutine
+        def produce(write):
+            # a retried request sends the block again from its start
+            body.rewind()
+            while True:
+                chunk = body.read(size)
+                if not chunk:
+                    break
+                # each piece is paced on the loop, where consume() would
+                # block it
+                wait = max([t.reserve(len(chunk)) for t in throttles] + [0])
+                if wait > 0:
+                    yield gen.sleep(wait)
+                yield write(chunk)
+        return produce
+
+    def _check_paced(self, bandwidth):
+        # a reply is read as fast as it arrives, since tornado cannot
+        # pause the connection, so a cap on it would not hold
+        if any(b.rate for b in self._throttles(bandwidth)):
+            raise NotImplementedError('AsyncClient paces uploads only; '
+                                      'download with a rate set needs the '
+                                      'blocking Client')
+
+    @gen.coroutine
+    def _fetch(self, request, delivered=None):
+        # Client._request on the loop: the limiter's wait and the retry
+        # backoff are slept with gen.sleep. A streamed reply is handed on
+        # as it arrives, so it is not retried once delivered() is true.
+        endpoint = self._endpoint(request.url)
+        idempotent = self._idempotent(request.method, dict(
+            urlparse.parse_qsl(urlparse.urlsplit(request.url).query)))
+        attempt = 0
+        if self.retry is not None:
+            self.retry.attempted()
+        while True:
+            if self.limiter is not None:
+                wait = self.limiter.reserve(endpoint)
+                if wait > 0:
+                    yield gen.sleep(wait)
+            response = yield self.http.fetch(request, raise_error=False)
+            # 599 means no HTTP response at all: connection error or
+            # timeout
+            error = response.code == 599 and response.error or None
+            if self.retry is None or (delivered and delivered()) or \
+                    not self.retry.should_retry(
+                        attempt, error is None and _Reply(response) or None,
+                        error and _retry_error(error), idempotent):
+                if error is not None:
+                    error.retries = attempt
+                    raise error
+                response.retries = attempt
+                raise gen.Return(response)
+            yield gen.sleep(self.retry.backoff(attempt))
+            attempt += 1
+
+    @gen.coroutine
+    def _call(self, method, url, result='json', bucksize=64 * 1024,
+              bandwidth=None, **kwargs):
+        # block bodies are paced by bandwidth and the client's own
+        # Bandwidth; content is refused when either has a rate
+        if result != 'json':
+            self._check_paced(bandwidth)
+        start = self.listeners and time.time()
+        if result == 'stream':
+            code, body = yield self._stream(method, url, start, kwargs)
+            raise gen.Return((code, body))
+        try:
+            response = yield self._fetch(self._http_request(
+                method, url, throttles=self._throttles(bandwidth), **kwargs))
+        except Exception as e:
+            if self.listeners:
+                self._emit(self._request_event(
+                    method, url, kwargs, None, time.time() - start, 0,
+                    getattr(e, 'retries', 0), e))
+            raise
+        if self.listeners:
+            self._emit(self._request_event(method, url, kwargs, response.code,
+                                           time.time() - start,
+                                           len(response.body or ''),
+                                           response.retries))
+        if result == 'json':
+            raise gen.Return((response.code, json.loads(response.body)))
+        raise gen.Return((response.code, response.body))
+
+    def _stream(self, method, url, start, kwargs):
+        # resolves to (status, BodyStream) once the final headers are in;
+        # the body keeps arriving after that. An error reply is held back
+        # until it is complete, so _fetch can still retry it.
+        body = BodyStream()
+        status = [None]
+        held = []
+        headers = Future()
+
+        def header_line(line):
+            if line.startswith('HTTP/'):
+                status[0] = int(line.split(' ', 2)[1])
+                del held[:]
+            elif not line.strip() and not headers.done() and \
+                    status[0] < 300:
+                # redirects are followed, so their headers are skipped
+                headers.set_result((status[0], body))
+
+        def put(chunk):
+            if headers.done():
+                body._put(chunk)
+            else:
+                held.append(chunk)
+
+        def finished(future):
+            error = future.exception()
+            if self.listeners:
+                self._emit(self._request_event(
+                    method, url, kwargs,
+                    error is None and future.result().code or None,
+                    time.time() - start, body.received + sum(map(len, held)),
+                    getattr(error or future.result(), 'retries', 0), error))
+            if not headers.done():
+                if error is not None:
+                    headers.set_exception(error)
+                else:
+                    headers.set_result((future.result().code, body))
+                    for chunk in held:
+                        body._put(chunk)
+            # None marks the end of the body
+            body.chunks.put_nowait(error)
+
+        request = self._http_request(method, url,
+                                     streaming_callback=put,
+                                     header_callback=header_line, **kwargs)
+        IOLoop.current().add_future(self._fetch(request, headers.done),
+                                    finished)
+        return headers
+
+    @gen.coroutine
+    def _then(self, future, callback):
+        result = yield future
+        callback(result)
+        raise gen.Return(result)
+
+    def _reply(self, result):
+        future = Future()
+        future.set_result(result)
+        return future
+
+    @gen.coroutine
+    def upload_single(self, path, file, ondup='overwrite', bandwidth=None):
+        # the file must stay open until its body has been sent
+        with open(file, 'rb') as f:
+            result = yield self._upload_single(path, f, ondup, bandwidth)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def _upload_block(self, file, index, chunksize, bandwidth=None):
+        try:
+            with open(file, 'rb') as f:
+                code, result = yield self._upload_tmp(f, index * chunksize,
+                                                      chunksize, bandwidth)
+        except (EnvironmentError, HTTPError) as e:
+            raise gen.Return((index, None, e))
+        if code == requests.codes.ok:
+            raise gen.Return((index, result['md5'], None))
+        raise gen.Return((index, None, result))
+
+    @gen.coroutine
+    def upload_multi(self, file, chunksize=1024 * 1024, workers=1,
+                     bandwidth=None):
+        # one Bandwidth, so the cap holds for all blocks together
+        bandwidth = throttle.bandwidth(bandwidth)
+        block_list, pending = self._blocks(file, chunksize)
+        if self.tuner is not None:
+            yield self._upload_multi_adaptive(file, chunksize, block_list,
+                                              pending, bandwidth)
+            raise gen.Return(block_list)
+        semaphore = Semaphore(workers)
+        errors = {}
+
+        @gen.coroutine
+        def send(index):
+            with (yield semaphore.acquire()):
+                index, md5, error = yield self._upload_block(
+                    file, index, chunksize, bandwidth)
+            if md5 is None:
+                errors[index] = error
+            else:
+                self._block_done(file, chunksize, block_list, index, md5)
+
+        yield [send(i) for i in pending]
+        if errors:
+            raise UploadError('%d of %d blocks failed' % (len(errors),
+                                                          len(block_list)),
+                              block_list, errors)
+        raise gen.Return(block_list)
+
+    @gen.coroutine
+    def _upload_timed(self, file, index, chunksize, bandwidth):
+        try:
+            with open(file, 'rb') as f:
+                body = BlockBody(f, index * chunksize, chunksize)
+                start = time.time()
+                code, result = yield self._send_tmp(body, bandwidth)
+                done = time.time()
+        except (EnvironmentError, HTTPError) as e:
+            raise gen.Return((index, None, e))
+        if code != requests.codes.ok:
+            raise gen.Return((index, None, result))
+        sent = body.sent or done
+        self.tuner.record(body.size, sent - start, done - sent)
+        raise gen.Return((index, result['md5'], None))
+
+    @gen.coroutine
+    def _upload_multi_adaptive(self, file, chunksize, block_list, pending,
+                               bandwidth=None):
+        # Client's version on the loop: tuner.workers blocks in flight,
+        # re-read after every block
+        results = Queue()
+
+        @gen.coroutine
+        def send(index):
+            try:
+                result = yield self._upload_timed(file, index, chunksize,
+                                                  bandwidth)
+            except Exception as e:
+                result = index, None, e
+            results.put_nowait(result)
+
+        errors = {}
+        todo = list(reversed(pending))
+        running = 0
+        self.tuner.start()
+        while todo or running:
+            while todo and running < self.tuner.workers:
+                IOLoop.current().spawn_callback(send, todo.pop())
+                running += 1
+            index, md5, error = yield results.get()
+            running -= 1
+            if md5 is None:
+                errors[index] = error
+            else:
+                self._block_done(file, chunksize, block_list, index, md5)
+
+        if errors:
+            raise UploadError('%d of %d blocks failed' % (len(errors),
+                                                          len(block_list)),
+                              block_list, errors)
+
+    @gen.coroutine
+    def upload(self, path, file, ondup='overwrite', workers=1, rapid=False,
+               rapid_min_size=256 * 1024L, bandwidth=None):
+        size = os.path.getsize(file)
+        if rapid and size > rapid_min_size:
+            code, result = yield self.rapid_upload_file(path, file, ondup)
+            if not self._rapid_missed(code, result):
+                result['strategy'] = 'rapid'
+                raise gen.Return((code, result))
+
+        if size <= self.chunksize:
+            strategy = 'single'
+            code, result = yield self.upload_single(path, file, ondup,
+                                                    bandwidth)
+        else:
+            strategy = 'multi'
+            chunksize = self._upload_chunksize(file, size)
+            block_list = yield self.upload_multi(file, chunksize, workers,
+                                                 bandwidth)
+            code, result = yield self.create_superfile(path, file,
+                                                       block_list, ondup)
+            if code == requests.codes.ok and self.journal is not None:
+                self.journal.discard(file, chunksize)
+            if self.tuner is not None:
+                result['tuning'] = dict(self.tuner.params(),
+                                        chunksize=chunksize)
+
+        if rapid:
+            result['strategy'] = strategy
+        raise gen.Return((code, result))
+
+    @gen.coroutine
+    def upload_tree(self, path, directory, ondup='overwrite', workers=1,
+                    rapid=True):
+        root = path.rstrip('/')
+        existing = {}
+        code, r = yield self.meta(root)
+        if code == requests.codes.ok and r['list'][0]['isdir']:
+            dirs, files = yield self._walk(root)
+            existing = dict((e['path'], e) for e in dirs + files)
+        tasks, skipped = self._tree_tasks(root, directory, existing)
+        semaphore = Semaphore(max(1, workers))
+        uploaded, errors = [], {}
+
+        @gen.coroutine
+        def send(task):
+            target, file = task
+            try:
+                with (yield semaphore.acquire()):
+                    if file is None:
+                        code, result = yield self.mkdir(target)
+                    else:
+                        code, result = yield self.upload(target, file, ondup,
+                                                         rapid=rapid)
+            except (UploadError, EnvironmentError, HTTPError) as e:
+                errors[target] = e
+                return
+            if code != requests.codes.ok:
+                errors[target] = result
+            else:
+                uploaded.append(target)
+
+        yield [send(t) for t in tasks]
+        if errors:
+            raise UploadError('%d of %d transfers failed' % (len(errors),
+                                                             len(tasks)),
+                              None, errors)
+        raise gen.Return({'uploaded': uploaded, 'skipped': skipped})
+
+    def _fetch_into(self, f, params, headers, expect):
+        # download into f, but only a reply with the expected status: a
+        # range the server ignored, or an error body, is never written
+        status = [None]
+        wrote = [False]
+
+        def header_line(line):
+            if line.startswith('HTTP/'):
+                status[0] = int(line.split(' ', 2)[1])
+
+        def write(chunk):
+            if status[0] == expect:
+                f.write(chunk)
+                wrote[0] = True
+
+        return self._fetch(self._http_request(
+            'GET', self.URI['file'],
+            params=params,
+            headers=headers,
+            streaming_callback=write,
+            header_callback=header_line), lambda: wrote[0])
+
+    @gen.coroutine
+    def _download_range(self, path, file, start, end):
+        params, headers = self._read_args(path, (start, end))
+        try:
+            with open(file, 'r+b') as f:
+                f.seek(start)
+                response = yield self._fetch_into(
+                    f, params, headers, requests.codes.partial)
+                if response.code != requests.codes.partial:
+                    raise gen.Return((start, response.code))
+                if f.tell() != end + 1:
+                    raise gen.Return((start, 'short read at %d' % f.tell()))
+        except (EnvironmentError, HTTPError) as e:
+            raise gen.Return((start, e))
+        raise gen.Return((start, None))
+
+    @gen.coroutine
+    def download(self, path, file=None, workers=1, resume=False,
+                 bandwidth=None):
+        self._check_paced(bandwidth)
+        if file is None:
+            file = os.path.split(path)[1]
+        code, meta = yield self.meta(path)
+        if code != requests.codes.ok:
+            raise DownloadError('meta %s failed: %d' % (path, code),
+                                {path: meta})
+        meta = meta['list'][0]
+        if meta.get('isdir') != 0:
+            result = yield self._download_dir(path, file, workers)
+            raise gen.Return(result)
+
+        if meta['size'] <= self.chunksize:
+            params, headers = self._read_args(path, None)
+            with open(file, 'wb') as f:
+                response = yield self._fetch_into(f, params, headers,
+                                                  requests.codes.ok)
+            if response.code != requests.codes.ok:
+                raise DownloadError('download %s failed: %d' % (
+                    path, response.code), {path: response.code})
+            raise gen.Return(file)
+
+        ranges, pending, state = self._ranges(file, meta, resume)
+        semaphore = Semaphore(workers)
+        errors = {}
+
+        @gen.coroutine
+        def fetch(r):
+            with (yield semaphore.acquire()):
+                start, error = yield self._download_range(path, file, *r)
+            if error is not None:
+                errors[start] = error
+                return
+            if state is not None:
+                state.mark(start)
+            if self.transfers:
+                self._advance('download', file,
+                              min(self.chunksize, meta['size'] - start))
+
+        yield [fetch(r) for r in pending]
+        if errors:
+            raise DownloadError('%d of %d ranges failed' % (len(errors),
+                                                            len(ranges)),
+                                errors)
+        if state is not None:
+            state.discard()
+        raise gen.Return(file)
+
+    @gen.coroutine
+    def thumbnail(self, path, width, height, quality=100, version=None):
+        # the version lookup is the only step Client cannot chain
+        if self.thumbnail_cache is not None and version is None:
+            code, r = yield self.meta(path)
+            if code != requests.codes.ok:
+                raise gen.Return((code, r))
+            version = file_version(r['list'][0])
+        result = yield super(AsyncClient, self).thumbnail(
+            path, width, height, quality, version)
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def prefetch_thumbnails(self, entries, width, height, quality=100,
+                            workers=8):
+        counts, todo = self._thumbnails_todo(entries, width, height, quality)
+        semaphore = Semaphore(workers)
+
+        @gen.coroutine
+        def fetch(e):
+            try:
+                with (yield semaphore.acquire()):
+                    code, content = yield self.thumbnail(
+                        e['path'], width, height, quality, file_version(e))
+            except (EnvironmentError, HTTPError):
+                code = None
+            if code == requests.codes.ok:
+                counts['fetched'] += 1
+            else:
+                counts['failed'] += 1
+
+        yield [fetch(e) for e in todo]
+        raise gen.Return(counts)
+
+    def stream_segments(self, path, type='M3U8_320_240', prefetch=4,
+                        bandwidth=None):
+        raise NotImplementedError('stream_segments prefetches on threads and '
+                                  'needs the blocking Client; fetch the '
+                                  'playlist with streaming() and parse it '
+                                  'with baidu.hls.parse_playlist')
+
+    def open(self, path, **kwargs):
+        raise NotImplementedError('open() reads synchronously and needs the '
+                                  'blocking Client; use read(range=...) on '
+                                  'AsyncClient')
+
+    def _pages(self, fetch, key, page, pool=None):
+        raise NotImplementedError('iter_list, iter_stream_list, iter_tasks '
+                                  'and iter_recycle need the blocking Client; '
+                                  'page with limit/start on AsyncClient')
+
+    @gen.coroutine
+    def _walk(self, path):
+        dirs, files, todo = [], [], [path]
+        while todo:
+            current, start = todo.pop(), 0
+            while True:
+                code, r = yield self.list(current, limit='%d-%d' % (
+                    start, start + self.LIST_PAGE))
+                if code != requests.codes.ok:
+                    raise ListError('listing failed: %d %s' % (code, r),
+                                    code, r)
+                for e in r['list']:
+                    if e['isdir']:
+                        dirs.append(e)
+                        todo.append(e['path'])
+                    else:
+                        files.append(e)
+                if len(r['list']) < self.LIST_PAGE:
+                    break
+                start += self.LIST_PAGE
+        raise gen.Return((dirs, files))
+
+    @gen.coroutine
+    def _metas(self, paths):
+        metas = []
+        for i in xrange(0, len(paths), self.META_BATCH):
+            code, r = yield self._meta_multi(paths[i:i + self.META_BATCH])
+            if code != requests.codes.ok:
+                raise Exception('meta failed: %s' % r)
+            metas.extend(r['list'])
+        raise gen.Return(metas)
+
+    @gen.coroutine
+    def _download_dir(self, path, target, workers, bandwidth=None):
+        dirs, files = yield self._walk(path)
+        metas = yield self._metas([e['path'] for e in files])
+        tasks, sizes = self._dir_tasks(path, target, dirs, metas)
+        semaphore = Semaphore(max(1, workers))
+        errors = {}
+
+        @gen.coroutine
+        def fetch(task):
+            with (yield semaphore.acquire()):
+                key, error = yield self._download_task(*task)
+            if error is not None:
+                errors[key] = error
+            elif self.transfers:
+                self._advance('download', target, sizes[key])
+
+        yield [fetch(t) for t in tasks]
+        if errors:
+            raise DownloadError('%d of %d transfers failed' % (len(errors),
+                                                               len(tasks)),
+                                errors)
+        raise gen.Return(target)
+
+    @gen.coroutine
+    def _download_task(self, path, file, start, end, bandwidth=None):
+        if start is not None:
+            start, error = yield self._download_range(path, file, start, end)
+            raise gen.Return(((path, start), error))
+        params, headers = self._read_args(path, None)
+        try:
+            with open(file, 'wb') as f:
+                response = yield self._fetch_into(f, params, headers,
+                                                  requests.codes.ok)
+        except (EnvironmentError, HTTPError) as e:
+            raise gen.Return((path, e))
+        if response.code != requests.codes.ok:
+            raise gen.Return((path, response.code))
+        raise gen.Return((path, None))
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+import time
+import copy
+import posixpath
+import threading
+from collections import OrderedDict
+
+
+class MetaCache(object):
+    ''' In-process TTL + LRU cache for meta and list replies.
+
+    Keys are tuples whose second item is the remote path, e.g.
+    ('meta', path) or ('list', path, by, order, limit). invalidate() drops
+    every entry for the given paths, their descendants and the listing of
+    their parent directories, and bumps a generation counter so a reply
+    fetched before the invalidation is not stored afterwards.
+    '''
+
+    def __init__(self, ttl=30, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return copy.deepcopy(entry[1])
+
+    def put(self, key, value, generation=None):
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, copy.deepcopy(value))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, *paths):
+        ''' Forget paths and everything below them; no paths clears all. '''
+        with self.lock:
+            self.generation += 1
+            if not paths:
+                self.entries.clear()
+                return
+            parents = set(posixpath.dirname(p.rstrip('/')) for p in paths)
+            prefixes = tuple(p.rstrip('/') + '/' for p in paths)
+            for key in list(self.entries):
+                path = key[1]
+                if path in paths or path.startswith(prefixes) or \
+                        (key[0] == 'list' and path.rstrip('/') in parents):
+                    del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_ratio': total and float(self.hits) / total or 0.0,
+                    'entries': len(self.entries)}
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+import requests
+
+
+class _Batch(object):
+
+    def __init__(self):
+        self.items = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.results = None
+
+
+class Coalescer(object):
+    ''' Folds single meta/delete/move/copy calls made from many threads
+    into the batch forms of the API.
+
+    The first call of a kind opens a batch and waits up to window seconds
+    (or until max_batch calls have joined) before sending it; every caller
+    then gets its own (status, reply) in the shape the single call has.
+    When a batched request fails as a whole, e.g. because one of its
+    paths is missing, each call is retried on its own so that only the
+    bad ones see the error. A failed delete, move or copy batch may have
+    been applied in part, so there meta first decides per call: one
+    already done (path gone; source gone and target there; copy target
+    there) is answered as applied, and only the others are resent. A
+    delete of a path that never existed is then answered as done too,
+    since its end state is the one asked for. For the blocking Client
+    only.
+    '''
+
+    def __init__(self, client, window=0.01, max_batch=None):
+        self.client = client
+        self.window = window
+        self.max_batch = max_batch or client.META_BATCH
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.requests = 0
+        self.calls = 0
+
+    def meta(self, path):
+        return self._submit('meta', path)
+
+    def delete(self, path):
+        return self._submit('delete', path)
+
+    def move(self, from_path, to_path):
+        return self._submit('move', (from_path, to_path))
+
+    def copy(self, from_path, to_path):
+        return self._submit('copy', (from_path, to_path))
+
+    def _submit(self, kind, item):
+        with self.lock:
+            self.calls += 1
+            batch = self.pending.get(kind)
+            leader = batch is None
+            if leader:
+                batch = self.pending[kind] = _Batch()
+            index = len(batch.items)
+            batch.items.append(item)
+            if len(batch.items) >= self.max_batch:
+                del self.pending[kind]
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self.lock:
+                if self.pending.get(kind) is batch:
+                    del self.pending[kind]
+            try:
+                batch.results = self._send(kind, batch.items)
+            except Exception as e:
+                batch.results = e
+            batch.done.set()
+        else:
+            batch.done.wait()
+
+        if isinstance(batch.results, Exception):
+            raise batch.results
+        return batch.results[index]
+
+    def _send(self, kind, items):
+        if len(items) == 1:
+            return [self._single(kind, items[0])]
+        with self.lock:
+            self.requests += 1
+
+        if kind == 'meta':
+            code, r = self.client._meta_multi(items)
+        elif kind == 'delete':
+            code, r = self.client._delete_multi(items)
+        else:
+            code, r = self.client._op_multi(kind, [f for f, t in items],
+                                            [t for f, t in items])
+        if code != requests.codes.ok:
+            if kind == 'meta':
+                return [self._single(kind, item) for item in items]
+            # a failed mutation may have been applied in part, so the
+            # items are only resent once meta shows they were not
+            return [self._confirm(kind, item, r) for item in items]
+
+        if kind == 'meta':
+            return self._split(code, r, r.get('list'), len(items),
+                               lambda e: {'list': [e]})
+        if kind in ('move', 'copy'):
+            return self._split(code, r, r.get('extra', {}).get('list'),
+                               len(items),
+                               lambda e: {'extra': {'list': [e]}})
+        return [(code, dict(r)) for item in items]
+
+    def _split(self, code, reply, entries, count, wrap):
+        # hand every caller its own entry of the batched reply
+        if entries is None or len(entries) != count:
+            return [(code, dict(reply)) for i in xrange(count)]
+        results = []
+        for e in entries:
+            r = wrap(e)
+            if 'request_id' in reply:
+                r['request_id'] = reply['request_id']
+            results.append((code, r))
+        return results
+
+    def _exists(self, path):
+        with self.lock:
+            self.requests += 1
+        return self.client._meta_single(path)[0] == requests.codes.ok
+
+    def _confirm(self, kind, item, reply):
+        if kind == 'delete':
+            applied = not self._exists(item)
+        elif kind == 'move':
+            applied = not self._exists(item[0]) and self._exists(item[1])
+        else:
+            # a copy is never repeated once its target is there
+            applied = self._exists(item[1])
+        if not applied:
+            return self._single(kind, item)
+        r = {}
+        if kind != 'delete':
+            r['extra'] = {'list': [{'from': item[0], 'to': item[1]}]}
+        if 'request_id' in reply:
+            r['request_id'] = reply['request_id']
+        return requests.codes.ok, r
+
+    def _single(self, kind, item):
+        with self.lock:
+            self.requests += 1
+        if kind == 'meta':
+            return self.client._meta_single(item)
+        if kind == 'delete':
+            return self.client._delete_single(item)
+        return self.client._op_single(kind, *item)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+import time
+import hashlib
+import binascii
+import sqlite3
+import threading
+
+SLICE_SIZE = 256 * 1024
+WINDOW_SIZE = 4 * 1024 * 1024
+
+
+def file_digests(file):
+    ''' Return (content_length, content_md5, slice_md5, content_crc32) as
+    rapidupload expects them, hashing the file in a single pass over a
+    read-only memory map; buffer() slices are handed to md5 and crc32
+    without copying the data.
+    '''
+    with open(file, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        md5 = hashlib.md5()
+        if size == 0:
+            return '0', md5.hexdigest(), md5.hexdigest(), '00000000'
+
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # the first window is exactly the slice, so slice-md5 is just
+            # a snapshot of the running md5.
+            window = buffer(m, 0, SLICE_SIZE)
+            md5.update(window)
+            crc = binascii.crc32(window)
+            slice_md5 = md5.hexdigest()
+            for offset in xrange(SLICE_SIZE, size, WINDOW_SIZE):
+                window = buffer(m, offset, WINDOW_SIZE)
+                md5.update(window)
+                crc = binascii.crc32(window, crc)
+        finally:
+            m.close()
+
+    return str(size), md5.hexdigest(), slice_md5, '%08x' % (crc & 0xffffffff)
+
+
+class DigestCache(object):
+    ''' Persistent cache of file_digests() keyed by (device, inode, size,
+    mtime), so unchanged files are never hashed twice.
+
+    At most max_entries rows are kept; the least recently used tenth is
+    evicted when the limit is hit.
+    '''
+
+    def __init__(self, path=None, max_entries=1000000):
+        if path is None:
+            directory = os.path.join(os.path.expanduser('~'), '.baidu-pcs')
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            path = os.path.join(directory, 'digests.db')
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # every lookup commits an atime update; WAL keeps that cheap
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS digests ('
+                        'dev INTEGER, ino INTEGER, size INTEGER, '
+                        'mtime REAL, content_md5 TEXT, slice_md5 TEXT, '
+                        'content_crc32 TEXT, atime REAL, '
+                        'PRIMARY KEY (dev, ino))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS digests_atime '
+                        'ON digests (atime)')
+        self.db.commit()
+        self.count = self.db.execute(
+            'SELECT COUNT(*) FROM digests').fetchone()[0]
+
+    def digests(self, file):
+        st = os.stat(file)
+        with self.lock:
+            row = self.db.execute(
+                'SELECT content_md5, slice_md5, content_crc32 FROM digests '
+                'WHERE dev = ? AND ino = ? AND size = ? AND mtime = ?',
+                (st.st_dev, st.st_ino, st.st_size, st.st_mtime)).fetchone()
+            if row is not None:
+                self.db.execute('UPDATE digests SET atime = ? '
+                                'WHERE dev = ? AND ino = ?',
+                                (time.time(), st.st_dev, st.st_ino))
+                self.db.commit()
+                return (str(st.st_size),) + tuple(str(v) for v in row)
+
+        result = file_digests(file)
+        with self.lock:
+            self._put(st, result)
+        return result
+
+    def _put(self, st, result):
+        # a stale row for the same inode is replaced, not added
+        self.count -= self.db.execute(
+            'DELETE FROM digests WHERE dev = ? AND ino = ?',
+            (st.st_dev, st.st_ino)).rowcount
+        if self.count >= self.max_entries:
+            self.count -= self.db.execute(
+                'DELETE FROM digests WHERE rowid IN (SELECT rowid FROM '
+                'digests ORDER BY atime LIMIT ?)',
+                (max(1, self.max_entries / 10),)).rowcount
+        self.db.execute('INSERT INTO digests VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        (st.st_dev, st.st_ino, st.st_size, st.st_mtime) +
+                        result[1:] + (time.time(),))
+        self.db.commit()
+        self.count += 1
+
+    def close(self):
+        self.db.close()
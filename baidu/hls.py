@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import time
+import collections
+import urlparse
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+
+def parse_playlist(playlist, base_url=None):
+    ''' [(duration, url)] of the segments of an M3U8 media playlist, with
+    relative segment URLs resolved against base_url.
+    '''
+    segments = []
+    duration = None
+    for line in playlist.splitlines():
+        line = line.strip()
+        if line.startswith('#EXTINF:'):
+            duration = float(line[len('#EXTINF:'):].split(',', 1)[0])
+        elif line and not line.startswith('#'):
+            if base_url:
+                line = urlparse.urljoin(base_url, line)
+            segments.append((duration, line))
+            duration = None
+    return segments
+
+
+class SegmentStream(object):
+    ''' The segments of path's HLS playlist, in order.
+
+    Iterating yields the content of each segment while the next prefetch
+    segments are already being downloaded on as many threads; at most
+    prefetch segments are buffered ahead of the reader. Once iteration
+    ends, startup holds the seconds until the first segment was ready and
+    stall the seconds the reader waited on later ones (stalls times), and
+    a 'streaming' event with the same figures goes to the client's
+    listeners. Segments are fetched on threads, so client must be the
+    blocking Client.
+    '''
+
+    def __init__(self, client, path, type='M3U8_320_240', prefetch=4,
+                 bandwidth=None):
+        self.client = client
+        self.path = path
+        self.type = type
+        self.prefetch = max(1, prefetch)
+        self.bandwidth = bandwidth
+        self.segments = None
+        self.startup = None
+        self.stall = 0.0
+        self.stalls = 0
+        self.received = 0
+
+    def _playlist(self):
+        code, playlist = self.client.streaming(self.path, self.type)
+        if code != requests.codes.ok:
+            raise IOError('streaming %s failed: %d %s' % (self.path, code,
+                                                          playlist))
+        return parse_playlist(playlist, self.client.URI['file'])
+
+    def _segment(self, url):
+        code, content = self.client._call('GET', url, result='content',
+                                          bandwidth=self.bandwidth)
+        if code != requests.codes.ok:
+            raise IOError('segment %s failed: %d' % (url, code))
+        return content
+
+    def __iter__(self):
+        start = time.time()
+        self.segments = self._playlist()
+        urls = iter([url for duration, url in self.segments])
+        pool = ThreadPool(self.prefetch)
+        pending = collections.deque()
+        try:
+            for url in urls:
+                pending.append(pool.apply_async(self._segment, (url,)))
+                if len(pending) >= self.prefetch:
+                    break
+            while pending:
+                result = pending.popleft()
+                waited = time.time()
+                ready = result.ready()
+                content = result.get()
+                waited = time.time() - waited
+                if self.startup is None:
+                    self.startup = time.time() - start
+                elif not ready:
+                    self.stall += waited
+                    self.stalls += 1
+                # refill before handing out, so the download continues
+                # while the reader is busy with this segment
+                url = next(urls, None)
+                if url is not None:
+                    pending.append(pool.apply_async(self._segment, (url,)))
+                self.received += len(content)
+                yield content
+        except GeneratorExit:
+            # the reader stopped early, no need to finish the prefetch
+            pool.terminate()
+            pool = None
+            raise
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            if self.client.listeners:
+                self.client._emit({'type': 'streaming',
+                                   'path': self.path,
+                                   'segments': len(self.segments),
+                                   'received': self.received,
+                                   'startup': self.startup,
+                                   'stall': self.stall,
+                                   'stalls': self.stalls})
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+import re as _re
+import sre_parse
+import sre_constants
+import posixpath
+import sqlite3
+import threading
+
+import requests
+
+FIELDS = ('path', 'fs_id', 'isdir', 'size', 'md5', 'mtime', 'ctime')
+
+
+class Index(object):
+    ''' Local SQLite mirror of the remote tree, kept current with diff().
+
+    sync() replays diff pages from the stored cursor until has_more is
+    false; a page with reset set wipes the mirror before its entries are
+    applied. Each page and its cursor are committed together, so an
+    interrupted sync resumes where it stopped. stat() and listdir() are
+    then answered from the mirror without a round trip.
+
+    Every name is also split into lower-cased trigrams, updated in the
+    same transaction as its entry, so search() narrows candidates with
+    the gram table instead of scanning all names.
+    '''
+
+    def __init__(self, client, path):
+        self.client = client
+        # lock guards the connection, sync_lock keeps syncs one at a time
+        # without blocking readers during the diff round trips.
+        self.lock = threading.RLock()
+        self.sync_lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        # the gram table is written in random key order; a larger page
+        # cache keeps a full bootstrap from thrashing
+        self.db.execute('PRAGMA cache_size=-65536')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS entries (
+                path TEXT PRIMARY KEY, parent TEXT, name TEXT,
+                fs_id INTEGER, isdir INTEGER, size INTEGER, md5 TEXT,
+                mtime INTEGER, ctime INTEGER);
+            CREATE INDEX IF NOT EXISTS entries_parent ON entries (parent);
+            CREATE INDEX IF NOT EXISTS entries_fs_id ON entries (fs_id);
+            CREATE TABLE IF NOT EXISTS grams (
+                gram TEXT, entry INTEGER, PRIMARY KEY (gram, entry))
+                WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS state (
+                key TEXT PRIMARY KEY, value TEXT);
+        ''')
+        self.db.commit()
+
+    def _query(self, sql, args=()):
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    @property
+    def cursor(self):
+        rows = self._query("SELECT value FROM state WHERE key = 'cursor'")
+        return rows and rows[0][0] or 'null'
+
+    def sync(self):
+        ''' Apply every pending diff page; return the number of changes. '''
+        changes = 0
+        with self.sync_lock:
+            while True:
+                code, r = self.client.diff(cursor=self.cursor)
+                if code != requests.codes.ok:
+                    raise Exception('diff failed: %d %s' % (code, r))
+                with self.lock, self.db:
+                    if r.get('reset'):
+                        self._reset()
+                    changes += self._apply(r.get('entries') or {})
+                    self.db.execute('INSERT OR REPLACE INTO state '
+                                    "VALUES ('cursor', ?)", (r['cursor'],))
+                if not r.get('has_more'):
+                    return changes
+
+    def _reset(self):
+        self.db.execute('DELETE FROM entries')
+        self.db.execute('DELETE FROM grams')
+
+    def _apply(self, entries):
+        # entries is keyed by path; accept a plain list as well
+        if isinstance(entries, dict):
+            entries = entries.values()
+        for e in entries:
+            path = e['path'].rstrip('/') or '/'
+            if e.get('isdelete'):
+                self._remove(path)
+                self._remove_children(path)
+            else:
+                if not e.get('isdir'):
+                    # a directory replaced by a file takes its subtree along
+                    self._remove_children(path)
+                self._insert(path, e)
+        return len(entries)
+
+    def _delete(self, where, args):
+        # grams are keyed by (gram, entry rowid); recompute them from the
+        # names instead of keeping a second index on entry.
+        rows = self.db.execute('SELECT rowid, name FROM entries WHERE ' +
+                               where, args).fetchall()
+        self.db.executemany('DELETE FROM grams WHERE gram = ? AND entry = ?',
+                            [(g, rowid) for rowid, name in rows
+                             for g in _trigrams(name)])
+        self.db.execute('DELETE FROM entries WHERE ' + where, args)
+
+    def _remove(self, path):
+        self._delete('path = ?', (path,))
+
+    def _remove_children(self, path):
+        # '0' sorts right after '/', so this range is exactly the subtree
+        self._delete('path >= ? AND path < ?', (path + '/', path + '0'))
+
+    def _insert(self, path, e):
+        self._remove(path)
+        name = posixpath.basename(path)
+        rowid = self.db.execute('INSERT INTO entries VALUES '
+                                '(?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                (path, posixpath.dirname(path), name,
+                                 e.get('fs_id'), e.get('isdir', 0),
+                                 e.get('size', 0), e.get('md5'),
+                                 e.get('mtime'), e.get('ctime'))).lastrowid
+        self.db.executemany('INSERT INTO grams VALUES (?, ?)',
+                            [(g, rowid) for g in _trigrams(name)])
+
+    def update(self, path, entries):
+        ''' Fold a list() page of directory path into the mirror: its
+        entries are upserted and children missing from it are dropped.
+        Only pass complete listings (no limit).
+        '''
+        path = path.rstrip('/') or '/'
+        names = set(e['path'].rstrip('/') for e in entries)
+        with self.lock, self.db:
+            for row in self.db.execute('SELECT path FROM entries '
+                                       'WHERE parent = ?', (path,)).fetchall():
+                if row[0] not in names:
+                    self._remove(row[0])
+                    self._remove_children(row[0])
+            self._apply(entries)
+
+    def _row(self, row):
+        return dict((k, row[k]) for k in FIELDS)
+
+    def stat(self, path):
+        rows = self._query('SELECT * FROM entries WHERE path = ?',
+                           (path.rstrip('/') or '/',))
+        return rows and self._row(rows[0]) or None
+
+    def stat_fs_id(self, fs_id):
+        rows = self._query('SELECT * FROM entries WHERE fs_id = ?', (fs_id,))
+        return rows and self._row(rows[0]) or None
+
+    def listdir(self, path):
+        return [self._row(row) for row in self._query(
+            'SELECT * FROM entries WHERE parent = ? ORDER BY name',
+            (path.rstrip('/') or '/',))]
+
+    def search(self, path, wd, re=0, regex=False):
+        ''' Local counterpart of Client.search: entries under path whose
+        name contains wd (case-insensitive), or matches the regular
+        expression wd when regex is true; re=1 searches recursively, as
+        on the server.
+        '''
+        if isinstance(wd, str):
+            wd = wd.decode('utf-8')
+        base = path.rstrip('/')
+        if re:
+            scope, args = 'path >= ? AND path < ?', [base + '/', base + '0']
+        else:
+            scope, args = 'parent = ?', [base or '/']
+
+        if regex:
+            pattern = _re.compile(wd)
+            literal = _required_literal(wd)
+
+            def match(name):
+                return pattern.search(name) is not None
+        else:
+            literal = wd.lower()
+
+            def match(name):
+                return literal in name.lower()
+
+        # any subset of the literal's grams is a valid filter; a few of
+        # them already cut the candidates down to a handful
+        grams = sorted(_trigrams(literal))[:8]
+        if grams:
+            candidates = ' INTERSECT '.join(
+                ['SELECT entry FROM grams WHERE gram = ?'] * len(grams))
+            scope += ' AND rowid IN (%s)' % candidates
+            args += grams
+        elif not regex and all(ord(c) < 128 for c in literal):
+            # too short for grams: let SQLite drop most rows first
+            scope += ' AND instr(lower(name), ?) > 0'
+            args.append(literal)
+        rows = self._query('SELECT * FROM entries WHERE %s ORDER BY path'
+                           % scope, args)
+        return [self._row(row) for row in rows if match(row['name'])]
+
+    def close(self):
+        self.db.close()
+
+
+def _trigrams(name):
+    name = name.lower()
+    return set(name[i:i + 3] for i in xrange(len(name) - 2))
+
+
+def _required_literal(pattern):
+    # longest run of plain characters every match must contain, used to
+    # pick candidates before running the regular expression.
+    try:
+        parsed = sre_parse.parse(pattern)
+    except sre_constants.error:
+        return ''
+    best, run = '', []
+    for op, av in list(parsed) + [(None, None)]:
+        if op == sre_constants.LITERAL:
+            run.append(unichr(av))
+        else:
+            if len(run) > len(best):
+                best = u''.join(run)
+            run = []
+    return best.lower()
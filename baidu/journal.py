@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import binascii
+import threading
+
+
+class UploadJournal(object):
+    ''' On-disk record of the tmpfile blocks already sent for a local file.
+
+    One append-only file per (path, size, mtime, chunksize); each line is
+    "<index> <md5>". A file that changed on disk gets a different key, so
+    stale blocks are never reused. A second file per (path, size, mtime)
+    remembers the chunksize, so a resumed upload can pick the same blocks.
+    '''
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.path.join(os.path.expanduser('~'),
+                                     '.baidu-pcs', 'journal')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.lock = threading.Lock()
+
+    def _name(self, file, chunksize):
+        st = os.stat(file)
+        key = '%s\0%d\0%r\0%d' % (os.path.abspath(file), st.st_size,
+                                  st.st_mtime, chunksize)
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest())
+
+    def _chunksize_name(self, file):
+        st = os.stat(file)
+        key = '%s\0%d\0%r' % (os.path.abspath(file), st.st_size,
+                              st.st_mtime)
+        return os.path.join(self.directory,
+                            hashlib.sha1(key).hexdigest() + '.chunksize')
+
+    def chunksize(self, file):
+        ''' The chunksize of the journal kept for file, or None. '''
+        try:
+            with open(self._chunksize_name(file)) as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return None
+
+    def blocks(self, file, chunksize):
+        ''' Return {block index: md5} of the blocks already uploaded. '''
+        blocks = {}
+        try:
+            with open(self._name(file, chunksize)) as f:
+                for line in f:
+                    fields = line.split()
+                    # a torn last line from a crash is simply ignored
+                    if len(fields) == 2 and len(fields[1]) == 32:
+                        blocks[int(fields[0])] = fields[1]
+        except IOError:
+            pass
+        return blocks
+
+    def record(self, file, chunksize, index, md5):
+        with self.lock:
+            name = self._chunksize_name(file)
+            if not os.path.exists(name):
+                with open(name, 'w') as f:
+                    f.write('%d' % chunksize)
+            with open(self._name(file, chunksize), 'a') as f:
+                f.write('%d %s\n' % (index, md5))
+
+    def discard(self, file, chunksize):
+        for name in (self._name(file, chunksize),
+                     self._chunksize_name(file)):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+
+class DownloadState(object):
+    ''' Sidecar file "<file>.pcs-state" tracking finished ranges of a download.
+
+    The state is only reused while the remote size, md5 and the range size
+    match what was recorded; otherwise the download starts over.
+    '''
+
+    SUFFIX = '.pcs-state'
+
+    def __init__(self, file, size, md5, chunksize):
+        self.name = file + self.SUFFIX
+        self.size = size
+        self.md5 = md5
+        self.chunksize = chunksize
+        self.lock = threading.Lock()
+        self.resumed = os.path.isfile(file) and \
+            os.path.getsize(file) == size and self._load()
+        if not self.resumed:
+            count = (size + chunksize - 1) / chunksize
+            self.bitmap = bytearray((count + 7) / 8)
+
+    def _load(self):
+        try:
+            with open(self.name) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return False
+        if (state.get('size'), state.get('md5'), state.get('chunksize')) != \
+                (self.size, self.md5, self.chunksize):
+            return False
+        self.bitmap = bytearray(binascii.unhexlify(state['done']))
+        return True
+
+    def done(self, start):
+        index = start / self.chunksize
+        return bool(self.bitmap[index / 8] & (1 << (index % 8)))
+
+    def mark(self, start):
+        index = start / self.chunksize
+        with self.lock:
+            self.bitmap[index / 8] |= 1 << (index % 8)
+            self._save()
+
+    def _save(self):
+        state = {'size': self.size,
+                 'md5': self.md5,
+                 'chunksize': self.chunksize,
+                 'done': binascii.hexlify(self.bitmap)}
+        tmp = self.name + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp, self.name)
+
+    def discard(self):
+        try:
+            os.remove(self.name)
+        except OSError:
+            pass
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import time
+import bisect
+import threading
+
+# upper bounds of the latency histogram, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Progress(object):
+    ''' Bytes done of one long transfer, turned into progress events. '''
+
+    def __init__(self, kind, path, total, done=0):
+        self.kind = kind
+        self.path = path
+        self.total = total
+        self.done = done
+        self.initial = done
+        self.start = time.time()
+        self.lock = threading.Lock()
+
+    def update(self, n):
+        with self.lock:
+            self.done += n
+            elapsed = time.time() - self.start
+            throughput = elapsed and (self.done - self.initial) / elapsed
+            eta = None
+            if throughput:
+                eta = max(0, self.total - self.done) / throughput
+            return {'type': 'progress',
+                    'transfer': self.kind,
+                    'path': self.path,
+                    'done': self.done,
+                    'total': self.total,
+                    'throughput': throughput,
+                    'eta': eta}
+
+
+class Metrics(object):
+    ''' Listener for Client.add_listener that aggregates request events
+    into counters and a latency histogram per (method, endpoint);
+    prometheus() renders them in the Prometheus text format.
+    '''
+
+    def __init__(self, prefix='pcs'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.requests = {}
+        self.sent = {}
+        self.received = {}
+        self.retries = {}
+        self.latency = {}
+
+    def __call__(self, event):
+        if event['type'] != 'request':
+            return
+        key = (event['method'], event['endpoint'])
+        status = event['status'] is None and 'error' or str(event['status'])
+        with self.lock:
+            count = key + (status,)
+            self.requests[count] = self.requests.get(count, 0) + 1
+            self.sent[key] = self.sent.get(key, 0) + event['sent']
+            self.received[key] = self.received.get(key, 0) + \
+                event['received']
+            self.retries[key] = self.retries.get(key, 0) + event['retries']
+            if key not in self.latency:
+                self.latency[key] = [[0] * (len(BUCKETS) + 1), 0.0]
+            buckets, total = self.latency[key]
+            buckets[bisect.bisect_left(BUCKETS, event['latency'])] += 1
+            self.latency[key][1] = total + event['latency']
+
+    def _labels(self, key, names=('method', 'endpoint', 'status')):
+        return ','.join('%s="%s"' % (n, v) for n, v in zip(names, key))
+
+    def _counter(self, lines, name, help, values):
+        name = '%s_%s' % (self.prefix, name)
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s counter' % name)
+        for key, value in sorted(values.items()):
+            lines.append('%s{%s} %s' % (name, self._labels(key), value))
+
+    def prometheus(self):
+        with self.lock:
+            lines = []
+            self._counter(lines, 'requests_total', 'HTTP requests sent.',
+                          self.requests)
+            self._counter(lines, 'sent_bytes_total', 'Request body bytes.',
+                          self.sent)
+            self._counter(lines, 'received_bytes_total',
+                          'Response body bytes.', self.received)
+            self._counter(lines, 'retries_total', 'Requests retried.',
+                          self.retries)
+
+            name = '%s_request_duration_seconds' % self.prefix
+            lines.append('# HELP %s Time until the reply.' % name)
+            lines.append('# TYPE %s histogram' % name)
+            for key, (buckets, total) in sorted(self.latency.items()):
+                labels = self._labels(key)
+                count = 0
+                for bound, n in zip(BUCKETS + ('+Inf',), buckets):
+                    count += n
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (
+                        name, labels, bound, count))
+                lines.append('%s_sum{%s} %s' % (name, labels, total))
+                lines.append('%s_count{%s} %d' % (name, labels, count))
+            return '\n'.join(lines) + '\n'
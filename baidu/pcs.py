@@ -1,10 +1,122 @@
 # -*- coding: utf-8 -*-
 
 import requests
+from requests.adapters import HTTPAdapter
 import os
 import json
-import hashlib
-import binascii
+import uuid
+import time
+import Queue
+import urllib
+import urlparse
+import itertools
+from multiprocessing.pool import ThreadPool
+from baidu.journal import DownloadState
+from baidu.hashcache import file_digests
+from baidu.thumbcache import thumbnail_key, file_version
+from baidu import throttle
+from baidu.metrics import Progress
+from baidu.remotefile import RemoteFile
+from baidu.hls import SegmentStream
+
+
+class UploadError(Exception):
+    ''' Raised when some blocks of a multi-part upload failed.
+
+    block_list keeps the md5 of every block that made it (None for the
+    failed ones) and errors maps block index to the server reply or the
+    exception, so the caller can retry just the missing blocks. For
+    upload_tree() block_list is None and errors is keyed by remote path.
+    '''
+
+    def __init__(self, message, block_list, errors):
+        super(UploadError, self).__init__(message)
+        self.block_list = block_list
+        self.errors = errors
+
+
+class DownloadError(Exception):
+    ''' Raised when some ranges of a parallel download failed.
+
+    errors maps the start offset of every failed range to the server
+    status or the exception; for directories the key is the remote path,
+    or (path, start) for a range of a big file.
+    '''
+
+    def __init__(self, message, errors):
+        super(DownloadError, self).__init__(message)
+        self.errors = errors
+
+
+class ListError(Exception):
+    ''' Raised by the paging iterators when a page cannot be fetched;
+    code and reply are the server's answer.
+    '''
+
+    def __init__(self, message, code, reply):
+        super(ListError, self).__init__(message)
+        self.code = code
+        self.reply = reply
+
+
+class BlockBody(object):
+    ''' multipart/form-data body for one tmpfile block, read lazily from
+    the open file so the block is never held in memory. requests sends it
+    as a stream with a fixed Content-Length; httplib pulls it in 8 KB
+    reads.
+    '''
+
+    def __init__(self, f, offset, size, name='file'):
+        self.f = f
+        self.offset = offset
+        self.size = max(0, min(size, os.fstat(f.fileno()).st_size - offset))
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % self.boundary
+        self.head = ('--%s\r\nContent-Disposition: form-data; name="%s"; '
+                     'filename="%s"\r\nContent-Type: '
+                     'application/octet-stream\r\n\r\n'
+                     % (self.boundary, name, name))
+        self.tail = '\r\n--%s--\r\n' % self.boundary
+        # Bandwidth objects paced by every piece read from the file
+        self.throttles = ()
+        self.rewind()
+
+    def rewind(self):
+        self.position = 0
+        # time the last byte was handed to the connection
+        self.sent = None
+        self.f.seek(self.offset)
+
+    def __len__(self):
+        return len(self.head) + self.size + len(self.tail)
+
+    def __iter__(self):
+        return iter(lambda: self.read(64 * 1024), '')
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            n = len(self)
+        out = []
+        while n > 0 and self.position < len(self):
+            pos = self.position
+            if pos < len(self.head):
+                chunk = self.head[pos:pos + n]
+            elif pos < len(self.head) + self.size:
+                left = len(self.head) + self.size - pos
+                chunk = self.f.read(min(n, left))
+                if not chunk:
+                    raise IOError('file shrank while uploading')
+                for t in self.throttles:
+                    t.consume(len(chunk))
+            else:
+                pos -= len(self.head) + self.size
+                chunk = self.tail[pos:pos + n]
+            self.position += len(chunk)
+            n -= len(chunk)
+            out.append(chunk)
+        if self.sent is None and self.position == len(self):
+            self.sent = time.time()
+        return ''.join(out)
 
 
 class Client(object):
@@ -16,88 +128,572 @@ class Client(object):
            'cloud_dl': 'https://pcs.baidu.com/rest/2.0/pcs/services/cloud_dl'
            }
 
-    def __init__(self, access_token, chunksize=4 * 1024 * 1024L):
+    # error_code of a rapidupload whose digests the server does not know
+    RAPID_UPLOAD_MISS = 31079
+    # entries per list() page and paths per batched meta request
+    LIST_PAGE = 1000
+    META_BATCH = 100
+    # POSTs that only read; every other POST changes something and is
+    # retried only when it cannot have reached the server.
+    IDEMPOTENT_POSTS = ('meta', 'query_task', 'list_task')
+
+    def __init__(self, access_token, chunksize=4 * 1024 * 1024L,
+                 pool_connections=10, pool_maxsize=10, session=None,
+                 journal=None, digest_cache=None, cache=None, limiter=None,
+                 retry=None, bandwidth=None, tuner=None,
+                 thumbnail_cache=None):
         self.access_token = access_token
         self.chunksize = chunksize
+        # an UploadJournal makes upload() resume from the first missing
+        # block after a failure.
+        self.journal = journal
+        # a DigestCache spares rapid_upload_file re-hashing unchanged files
+        self.digest_cache = digest_cache
+        # a MetaCache answers repeated meta/list calls locally; mutating
+        # calls made through this client invalidate what they touch.
+        self.cache = cache
+        # a RateLimiter paces requests per endpoint and a RetryPolicy
+        # retries throttled or failed ones, see baidu.ratelimit.
+        self.limiter = limiter
+        self.retry = retry
+        # caps the bytes per second of all transfers of this client on top
+        # of their own bandwidth argument; shared process-wide by default.
+        self.bandwidth = throttle.GLOBAL if bandwidth is None else bandwidth
+        # an UploadTuner sizes and schedules the blocks of upload() from
+        # measured throughput instead of chunksize and workers.
+        self.tuner = tuner
+        # a ThumbnailCache keeps generated thumbnails on disk, keyed by
+        # the file's md5 so changed files are generated again.
+        self.thumbnail_cache = thumbnail_cache
+        # callables given an event dict for every HTTP call and for the
+        # progress of long transfers; see add_listener.
+        self.listeners = []
+        self.transfers = {}
+        # one keep-alive session per client; the urllib3 pool behind it is
+        # thread safe, so a client may be shared across threads.
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_connections,
+                                  pool_maxsize=pool_maxsize)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+        self.session = session
+
+    def _endpoint(self, url):
+        # playlist segments carry their own query string
+        url = url.split('?', 1)[0]
+        for name, uri in self.URI.items():
+            if uri == url:
+                return name
+        return url
+
+    def _request(self, method, url, **kwargs):
+        if self.limiter is None and self.retry is None:
+            return self.session.request(method, url, **kwargs)
+
+        endpoint = self._endpoint(url)
+        idempotent = self._idempotent(method, kwargs.get('params') or {})
+        attempt = 0
+        if self.retry is not None:
+            self.retry.attempted()
+        while True:
+            if self.limiter is not None:
+                self.limiter.acquire(endpoint)
+            response = error = None
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.RequestException as e:
+                error = e
+            if self.retry is None or not self.retry.should_retry(
+                    attempt, response, error, idempotent):
+                if error is not None:
+                    error.retries = attempt
+                    raise error
+                response.retries = attempt
+                return response
+            if response is not None:
+                # hand a streamed reply's connection back to the pool
+                response.close()
+            time.sleep(self.retry.backoff(attempt))
+            attempt += 1
+            if isinstance(kwargs.get('data'), BlockBody):
+                kwargs['data'].rewind()
+
+    def _idempotent(self, http_method, params):
+        # whether repeating a call that may have been applied is harmless
+        if http_method == 'GET' or params.get('method') in \
+                self.IDEMPOTENT_POSTS:
+            return True
+        return params.get('method') == 'upload' and \
+            (params.get('type') == 'tmpfile' or
+             params.get('ondup', 'overwrite') == 'overwrite')
+
+    def _call(self, method, url, result='json', bucksize=64 * 1024,
+              bandwidth=None, **kwargs):
+        ''' Send a request and return (status, body); body is the decoded
+        json, the raw content or, for result='stream', an iterator of
+        bucksize chunks. AsyncClient overrides this one method, so both
+        clients build every request the same way.
+
+        Block bodies and content are paced by bandwidth and the client's
+        own Bandwidth.
+        '''
+        throttles = self._throttles(bandwidth)
+        limited = any(b.rate for b in throttles)
+        if limited:
+            bucksize = min(bucksize, throttle.QUANTUM)
+        if isinstance(kwargs.get('data'), BlockBody):
+            kwargs['data'].throttles = throttles
+
+        stream = result == 'stream' or (limited and result == 'content')
+        start = self.listeners and time.time()
+        try:
+            r = self._request(method, url, stream=stream, **kwargs)
+        except requests.RequestException as e:
+            if self.listeners:
+                self._emit(self._request_event(
+                    method, url, kwargs, None, time.time() - start, 0,
+                    getattr(e, 'retries', 0), e))
+            raise
+
+        if result == 'json':
+            body = r.json()
+        elif stream:
+            body = throttle.throttled(r.iter_content(bucksize), throttles)
+            if result != 'stream':
+                body = ''.join(body)
+        else:
+            body = r.content
+        if self.listeners:
+            if result == 'stream':
+                received = int(r.headers.get('content-length') or 0)
+            else:
+                received = len(r.content) if result == 'json' else len(body)
+            self._emit(self._request_event(
+                method, url, kwargs, r.status_code, time.time() - start,
+                received, getattr(r, 'retries', 0)))
+        return r.status_code, body
+
+    def _throttles(self, bandwidth):
+        # the Bandwidths pacing a transfer: its own and the client's
+        return [b for b in (throttle.bandwidth(bandwidth), self.bandwidth)
+                if b is not None]
+
+    def add_listener(self, listener):
+        ''' Call listener(event) for every HTTP call and for the progress
+        of multi-part uploads and ranged downloads.
+
+        Request events carry type 'request', the PCS method, http_method,
+        endpoint, status (None on a connection error), latency in seconds,
+        sent and received body bytes, retries and error. Progress events
+        carry type 'progress', transfer ('upload' or 'download'), path,
+        done and total bytes, throughput in bytes per second and eta in
+        seconds. Without listeners nothing is measured.
+        '''
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def _emit(self, event):
+        for listener in list(self.listeners):
+            listener(event)
+
+    def _request_event(self, http_method, url, kwargs, status, latency,
+                       received, retries, error=None):
+        data = kwargs.get('data')
+        if isinstance(data, dict):
+            sent = len(urllib.urlencode(data))
+        else:
+            sent = data is not None and len(data) or 0
+        method = (kwargs.get('params') or {}).get('method')
+        if method is None and '?' in url:
+            method = dict(urlparse.parse_qsl(url.split('?', 1)[1])).get(
+                'method')
+        return {'type': 'request',
+                'method': method,
+                'http_method': http_method,
+                'endpoint': self._endpoint(url),
+                'status': status,
+                'latency': latency,
+                'sent': sent,
+                'received': received,
+                'retries': retries,
+                'error': error}
+
+    def _track(self, kind, path, total, done=0):
+        # progress of a long transfer, only followed while listened to
+        if self.listeners:
+            self.transfers[(kind, path)] = Progress(kind, path, total, done)
+
+    def _advance(self, kind, path, n):
+        progress = self.transfers.get((kind, path))
+        if progress is not None:
+            event = progress.update(n)
+            if event['done'] >= event['total']:
+                self.transfers.pop((kind, path), None)
+            self._emit(event)
+
+    def close(self):
+        self.session.close()
+
+    def _then(self, result, callback):
+        # hand the (status, body) reply to callback; AsyncClient waits for
+        # its future first.
+        callback(result)
+        return result
+
+    def _reply(self, result):
+        return result
+
+    def _cached(self, key, call):
+        if self.cache is None:
+            return call()
+        hit = self.cache.get(key)
+        if hit is not None:
+            return self._reply(hit)
+
+        generation = self.cache.generation
+
+        def store(result):
+            if result[0] == requests.codes.ok:
+                self.cache.put(key, result, generation)
+        return self._then(call(), store)
+
+    def _mutated(self, result, *paths):
+        if self.cache is None:
+            return result
+        return self._then(result, lambda r: self.cache.invalidate(*paths))
 
     def info(self):
         params = {'method': 'info',
                   'access_token': self.access_token
                   }
-        r = requests.get(self.URI['quota'], params=params)
-        return r.status_code, r.json()
+        return self._call('GET', self.URI['quota'], params=params)
 
-    def upload_single(self, path, file, ondup='overwrite'):
+    def upload_single(self, path, file, ondup='overwrite', bandwidth=None):
+        with open(file, 'rb') as f:
+            return self._upload_single(path, f, ondup, bandwidth)
+
+    def _upload_single(self, path, f, ondup, bandwidth=None):
         params = {'method': 'upload',
                   'access_token': self.access_token,
                   'path': path,
                   'ondup': ondup}
-
-        with open(file, 'rb') as f:
-            files = {'file': f}
-            r = requests.post(self.URI['file'],
-                              params=params,
-                              files=files)
-
-        return r.status_code, r.json()
-
-    def _upload_tmp(self, f, offset, size):
+        body = BlockBody(f, 0, os.fstat(f.fileno()).st_size)
+        return self._mutated(
+            self._call('POST', self.URI['file'],
+                       params=params,
+                       data=body,
+                       headers={'Content-Type': body.content_type},
+                       bandwidth=bandwidth),
+            path)
+
+    def _upload_tmp(self, f, offset, size, bandwidth=None):
+        return self._send_tmp(BlockBody(f, offset, size), bandwidth)
+
+    def _send_tmp(self, body, bandwidth=None):
         params = {'method': 'upload',
                   'access_token': self.access_token,
                   'type': 'tmpfile'}
-        f.seek(offset)
-        files = {'file': f.read(size)}
-        r = requests.post(self.URI['file'],
+        return self._call('POST', self.URI['file'],
                           params=params,
-                          files=files)
-
-        return r.status_code, r.json()
+                          data=body,
+                          headers={'Content-Type': body.content_type},
+                          bandwidth=bandwidth)
 
-    def upload_multi(self, file, chunksize=1024 * 1024):
+    def _blocks(self, file, chunksize):
+        # the block list to fill in, seeded from the journal, and the
+        # indices of the blocks still to send.
         size = os.path.getsize(file)
         if size <= chunksize or size > 1024L * chunksize:
             # TODO
             raise Exception("...")
 
-        block_list = []
+        count = (size + chunksize - 1) / chunksize
+        block_list = [None] * count
+        if self.journal is not None:
+            for index, md5 in self.journal.blocks(file, chunksize).items():
+                if index < count:
+                    block_list[index] = md5
+        pending = [i for i, md5 in enumerate(block_list) if md5 is None]
+        self._track('upload', file, size, size - sum(
+            min(chunksize, size - i * chunksize) for i in pending))
+        return block_list, pending
+
+    def upload_multi(self, file, chunksize=1024 * 1024, workers=1,
+                     bandwidth=None):
+        ''' bandwidth caps this upload, in bytes per second or as a
+        Bandwidth shared with other transfers.
+        '''
+        block_list, pending = self._blocks(file, chunksize)
+        bandwidth = throttle.bandwidth(bandwidth)
+
+        if self.tuner is not None:
+            self._upload_multi_adaptive(file, chunksize, block_list, pending,
+                                        bandwidth)
+            return block_list
+
+        if workers > 1:
+            self._upload_multi_parallel(file, chunksize, workers,
+                                        block_list, pending, bandwidth)
+            return block_list
+
         with open(file, 'rb') as f:
-            offset = 0
-            while offset < size:
-                code, result = self._upload_tmp(f, offset, chunksize)
-                if code == requests.codes.ok:
-                    block_list.append(result['md5'])
-                    offset += chunksize
-                else:
-                    # TODO
-                    raise Exception("...")
+            for index in pending:
+                code, result = self._upload_tmp(f, index * chunksize,
+                                                chunksize, bandwidth)
+                if code != requests.codes.ok:
+                    raise UploadError('block %d of %d failed' % (
+                        index, len(block_list)), block_list, {index: result})
+                self._block_done(file, chunksize, block_list,
+                                 index, result['md5'])
 
         return block_list
 
+    def _block_done(self, file, chunksize, block_list, index, md5):
+        block_list[index] = md5
+        if self.journal is not None:
+            self.journal.record(file, chunksize, index, md5)
+        if self.transfers:
+            self._advance('upload', file, min(
+                chunksize, os.path.getsize(file) - index * chunksize))
+
+    def _upload_block(self, file, index, chunksize, bandwidth=None):
+        # every worker reads through its own handle, so at most one block
+        # per worker is held in memory.
+        try:
+            with open(file, 'rb') as f:
+                code, result = self._upload_tmp(f, index * chunksize,
+                                                chunksize, bandwidth)
+        except (IOError, requests.RequestException) as e:
+            return index, None, e
+        if code == requests.codes.ok:
+            return index, result['md5'], None
+        return index, None, result
+
+    def _upload_multi_parallel(self, file, chunksize, workers,
+                               block_list, pending, bandwidth=None):
+        errors = {}
+        pool = ThreadPool(workers)
+        try:
+            for index, md5, error in pool.imap_unordered(
+                    lambda i: self._upload_block(file, i, chunksize,
+                                                 bandwidth),
+                    pending):
+                if md5 is None:
+                    errors[index] = error
+                else:
+                    self._block_done(file, chunksize, block_list, index, md5)
+        finally:
+            pool.close()
+            pool.join()
+
+        if errors:
+            raise UploadError('%d of %d blocks failed' % (len(errors),
+                                                          len(block_list)),
+                              block_list, errors)
+
+    def _upload_timed(self, file, index, chunksize, bandwidth):
+        # _upload_block that also feeds the tuner its send and wait times
+        try:
+            with open(file, 'rb') as f:
+                body = BlockBody(f, index * chunksize, chunksize)
+                start = time.time()
+                code, result = self._send_tmp(body, bandwidth)
+                done = time.time()
+        except (IOError, requests.RequestException) as e:
+            return index, None, e
+        if code != requests.codes.ok:
+            return index, None, result
+        sent = body.sent or done
+        self.tuner.record(body.size, sent - start, done - sent)
+        return index, result['md5'], None
+
+    def _upload_multi_adaptive(self, file, chunksize, block_list, pending,
+                               bandwidth=None):
+        # like _upload_multi_parallel, but keeps only tuner.workers blocks
+        # in flight, re-read after every block.
+        results = Queue.Queue()
+
+        def send(index):
+            try:
+                result = self._upload_timed(file, index, chunksize,
+                                            bandwidth)
+            except Exception as e:
+                result = index, None, e
+            results.put(result)
+
+        errors = {}
+        todo = list(reversed(pending))
+        running = 0
+        pool = ThreadPool(self.tuner.max_workers)
+        self.tuner.start()
+        try:
+            while todo or running:
+                while todo and running < self.tuner.workers:
+                    pool.apply_async(send, (todo.pop(),))
+                    running += 1
+                index, md5, error = results.get()
+                running -= 1
+                if md5 is None:
+                    errors[index] = error
+                else:
+                    self._block_done(file, chunksize, block_list, index, md5)
+        finally:
+            pool.close()
+            pool.join()
+
+        if errors:
+            raise UploadError('%d of %d blocks failed' % (len(errors),
+                                                          len(block_list)),
+                              block_list, errors)
+
     def create_superfile(self, path, file, block_list, ondup='overwrite'):
         params = {'method': 'createsuperfile',
                   'access_token': self.access_token,
                   'path': path,
                   'ondup': ondup}
 
-        r = requests.post(
+        return self._mutated(self._call(
+            'POST',
             self.URI['file'],
             params=params,
             data={'param': json.dumps({'block_list': block_list})}
-        )
-
-        return r.status_code, r.json()
-
-    def upload(self, path, file, ondup='overwrite'):
+        ), path)
+
+    def upload(self, path, file, ondup='overwrite', workers=1, rapid=False,
+               rapid_min_size=256 * 1024L, bandwidth=None):
+        ''' With rapid=True, files larger than rapid_min_size are first
+        offered to rapidupload by digest, and only sent in full when the
+        server does not know the content. The result then carries the
+        path taken under 'strategy': 'rapid', 'single' or 'multi'.
+        bandwidth caps the transfer as in upload_multi. With a tuner, a
+        multi-part upload reports its block size and the tuner's state
+        under 'tuning'.
+        '''
         size = os.path.getsize(file)
+        if rapid and size > rapid_min_size:
+            code, result = self.rapid_upload_file(path, file, ondup)
+            if not self._rapid_missed(code, result):
+                result['strategy'] = 'rapid'
+                return code, result
+
         if size <= self.chunksize:
-            return self.upload_single(path, file, ondup)
+            strategy = 'single'
+            code, result = self.upload_single(path, file, ondup, bandwidth)
+        else:
+            strategy = 'multi'
+            chunksize = self._upload_chunksize(file, size)
+            block_list = self.upload_multi(file, chunksize, workers,
+                                           bandwidth)
+            code, result = self.create_superfile(path, file, block_list,
+                                                 ondup)
+            if code == requests.codes.ok and self.journal is not None:
+                self.journal.discard(file, chunksize)
+            if self.tuner is not None:
+                result['tuning'] = dict(self.tuner.params(),
+                                        chunksize=chunksize)
+
+        if rapid:
+            result['strategy'] = strategy
+        return code, result
+
+    def upload_tree(self, path, directory, ondup='overwrite', workers=1,
+                    rapid=True):
+        ''' Upload the local directory tree into the remote directory path.
+
+        The remote tree is listed once; files whose size and md5 already
+        match are skipped. The others go through upload() on a pool of
+        workers, so each picks rapid, single or multi-part upload by
+        itself. Uploads create their parent directories, so mkdir is only
+        sent for empty directories. Returns {'uploaded': [...],
+        'skipped': [...]} with remote paths.
+        '''
+        root = path.rstrip('/')
+        existing = {}
+        code, r = self.meta(root)
+        if code == requests.codes.ok and r['list'][0]['isdir']:
+            dirs, files = self._walk(root)
+            existing = dict((e['path'], e) for e in dirs + files)
+        tasks, skipped = self._tree_tasks(root, directory, existing)
+
+        def send(task):
+            target, file = task
+            try:
+                if file is None:
+                    code, result = self.mkdir(target)
+                else:
+                    code, result = self.upload(target, file, ondup,
+                                               rapid=rapid)
+            except (UploadError, EnvironmentError,
+                    requests.RequestException) as e:
+                return target, e
+            return target, code != requests.codes.ok and result or None
+
+        uploaded, errors = [], {}
+        pool = ThreadPool(max(1, workers))
+        try:
+            for target, error in pool.imap_unordered(send, tasks):
+                if error is None:
+                    uploaded.append(target)
+                else:
+                    errors[target] = error
+        finally:
+            pool.close()
+            pool.join()
+
+        if errors:
+            raise UploadError('%d of %d transfers failed' % (len(errors),
+                                                             len(tasks)),
+                              None, errors)
+        return {'uploaded': uploaded, 'skipped': skipped}
+
+    def _tree_tasks(self, root, directory, existing):
+        # (remote path, local file) still to send, with None for empty
+        # directories to create, and the remote paths already up to date.
+        def remote(p):
+            rel = os.path.relpath(p, directory)
+            return root if rel == os.curdir else \
+                '/'.join([root] + rel.split(os.sep))
+
+        tasks, skipped = [], []
+        for parent, subdirs, names in os.walk(directory):
+            if not subdirs and not names and \
+                    remote(parent) not in existing:
+                tasks.append((remote(parent), None))
+            for name in names:
+                file = os.path.join(parent, name)
+                meta = existing.get(remote(file))
+                if meta is not None and not meta['isdir'] and \
+                        meta['size'] == os.path.getsize(file) and \
+                        meta['md5'] == self._local_md5(file):
+                    skipped.append(remote(file))
+                else:
+                    tasks.append((remote(file), file))
+        return tasks, skipped
 
+    def _rapid_missed(self, code, result):
+        return code != requests.codes.ok and \
+            result.get('error_code') == self.RAPID_UPLOAD_MISS
+
+    def _multi_chunksize(self, size):
+        # smallest power-of-two multiple of chunksize within 1024 blocks
         chunksize = self.chunksize
         while size > 1024 * chunksize:
             chunksize *= 2
-
-        block_list = self.upload_multi(file, chunksize)
-        return self.create_superfile(path, file, block_list, ondup)
+        return chunksize
+
+    def _upload_chunksize(self, file, size):
+        # a journaled upload resumes with the blocks it started with,
+        # whatever the tuner would pick now
+        journaled = self.journal is not None and self.journal.chunksize(file)
+        if journaled:
+            return journaled
+        chunksize = self._multi_chunksize(size)
+        if self.tuner is not None:
+            chunksize = self.tuner.chunksize(chunksize, size)
+        return chunksize
 
     def delete(self, path):
         if type(path) is list:
@@ -109,22 +705,36 @@ class Client(object):
         params = {'method': 'delete',
                   'access_token': self.access_token,
                   'path': path}
-        r = requests.post(self.URI['file'],
-                          params=params)
-
-        return r.status_code, r.json()
+        return self._mutated(self._call('POST', self.URI['file'],
+                                        params=params),
+                             path)
 
     def _delete_multi(self, path):
         params = {'method': 'delete',
                   'access_token': self.access_token}
         paths = {'list': [{'path': p} for p in path]}
-        r = requests.post(self.URI['file'],
+        return self._mutated(self._call('POST', self.URI['file'],
+                                        params=params,
+                                        data={'param': json.dumps(paths)}),
+                             *path)
+
+    def read(self, path, range=None, stream=False, bucksize=64 * 1024L,
+             bandwidth=None):
+        params, headers = self._read_args(path, range)
+        return self._call('GET', self.URI['file'],
                           params=params,
-                          data={'param': json.dumps(paths)})
-
-        return r.status_code, r.json()
-
-    def read(self, path, range=None, stream=False, bucksize=64 * 1024L):
+                          headers=headers,
+                          result=stream and 'stream' or 'content',
+                          bucksize=bucksize,
+                          bandwidth=bandwidth)
+
+    def open(self, path, **kwargs):
+        ''' A seekable, read-only file object over path, see RemoteFile.
+        Its reads block, so AsyncClient does not offer it.
+        '''
+        return RemoteFile(self, path, **kwargs)
+
+    def _read_args(self, path, range):
         params = {'method': 'download',
                   'access_token': self.access_token,
                   'path': path}
@@ -137,19 +747,16 @@ class Client(object):
                 end = int(range[1])
             ran = end and 'bytes=%d-%d' % (start, end) or 'bytes=%d-' % (start)
             headers = {'Range': ran}
-        r = requests.get(self.URI['file'],
-                         params=params,
-                         headers=headers,
-                         stream=stream)
+        return params, headers
 
-        if stream:
-            return r.status_code, r.iter_content(bucksize)
-        else:
-            return r.status_code, r.content
-
-    def download(self, path, file=None):
+    def download(self, path, file=None, workers=1, resume=False,
+                 bandwidth=None):
+        ''' bandwidth caps the whole download, in bytes per second or as
+        a Bandwidth shared with other transfers.
+        '''
         if file is None:
             file = os.path.split(path)[1]
+        bandwidth = throttle.bandwidth(bandwidth)
         code, meta = self.meta(path)
         if code != requests.codes.ok:
             # TODO
@@ -157,12 +764,16 @@ class Client(object):
         meta = meta['list'][0]
         if 'isdir' in meta and meta['isdir'] == 0:
             size = meta['size']
-            if size > self.chunksize:
+            if size > self.chunksize and (workers > 1 or resume):
+                self._download_ranges(path, file, meta, workers, resume,
+                                      bandwidth)
+            elif size > self.chunksize:
                 start, end = 0L, self.chunksize
                 with open(file, 'wb') as f:
                     while start < size:
                         code, content = self.read(path, range=(
-                            start, end - 1), stream=True)
+                            start, end - 1), stream=True,
+                            bandwidth=bandwidth)
                         if code == requests.codes.partial:
                             for c in content:
                                 f.write(c)
@@ -175,7 +786,8 @@ class Client(object):
                         if end >= size:
                             end = size
             else:
-                code, content = self.read(path, stream=True)
+                code, content = self.read(path, stream=True,
+                                          bandwidth=bandwidth)
                 if code == requests.codes.ok:
                     with open(file, 'wb') as f:
                         for c in content:
@@ -185,7 +797,190 @@ class Client(object):
                     raise Exception('...')
 
             return file
-        # TODO isdir = 1 ??
+        return self._download_dir(path, file, workers, bandwidth)
+
+    def _walk(self, path):
+        # list() entries of every directory and file below path
+        dirs, files, todo = [], [], [path]
+        # one prefetch thread for the whole walk, not one per directory
+        pool = ThreadPool(1)
+        try:
+            while todo:
+                for e in self._pages(self._list_page(todo.pop()), 'list',
+                                     self.LIST_PAGE, pool):
+                    if e['isdir']:
+                        dirs.append(e)
+                        todo.append(e['path'])
+                    else:
+                        files.append(e)
+        finally:
+            pool.close()
+            pool.join()
+        return dirs, files
+
+    def _metas(self, paths):
+        # meta of many paths, META_BATCH per request
+        metas = []
+        for i in xrange(0, len(paths), self.META_BATCH):
+            code, r = self._meta_multi(paths[i:i + self.META_BATCH])
+            if code != requests.codes.ok:
+                raise Exception('meta failed: %s' % r)
+            metas.extend(r['list'])
+        return metas
+
+    def _local_md5(self, file):
+        if self.digest_cache is not None:
+            return self.digest_cache.digests(file)[1]
+        return file_digests(file)[1]
+
+    def _download_dir(self, path, target, workers, bandwidth=None):
+        ''' Mirror the remote directory path into target.
+
+        Local files whose size and md5 already match are skipped. Small
+        files and the ranges of big ones share one pool of workers,
+        smallest files first, so at most workers requests are in flight.
+        '''
+        dirs, files = self._walk(path)
+        tasks, sizes = self._dir_tasks(
+            path, target, dirs, self._metas([e['path'] for e in files]))
+
+        errors = {}
+        pool = ThreadPool(max(1, workers))
+        try:
+            for key, error in pool.imap_unordered(
+                    lambda t: self._download_task(*t + (bandwidth,)),
+                    tasks):
+                if error is not None:
+                    errors[key] = error
+                elif self.transfers:
+                    self._advance('download', target, sizes[key])
+        finally:
+            pool.close()
+            pool.join()
+
+        if errors:
+            raise DownloadError('%d of %d transfers failed' % (len(errors),
+                                                               len(tasks)),
+                                errors)
+        return target
+
+    def _dir_tasks(self, path, target, dirs, metas):
+        # create the local tree and return the downloads still needed,
+        # (path, file, start, end) with start None for whole files, and
+        # the size of each keyed as its result will be.
+        root = path.rstrip('/')
+
+        def local(p):
+            return os.path.join(target, *p[len(root) + 1:].split('/'))
+
+        for d in [root] + [e['path'] for e in dirs]:
+            if not os.path.isdir(local(d)):
+                os.makedirs(local(d))
+
+        tasks, sizes = [], {}
+        for meta in sorted(metas, key=lambda m: m['size']):
+            file = local(meta['path'])
+            if os.path.isfile(file) and \
+                    os.path.getsize(file) == meta['size'] and \
+                    self._local_md5(file) == meta['md5']:
+                continue
+            if meta['size'] <= self.chunksize:
+                tasks.append((meta['path'], file, None, None))
+                sizes[meta['path']] = meta['size']
+                continue
+            with open(file, 'wb') as f:
+                f.truncate(meta['size'])
+            for start in xrange(0, meta['size'], self.chunksize):
+                end = min(start + self.chunksize, meta['size']) - 1
+                tasks.append((meta['path'], file, start, end))
+                sizes[(meta['path'], start)] = end + 1 - start
+        self._track('download', target, sum(sizes.values()))
+        return tasks, sizes
+
+    def _download_task(self, path, file, start, end, bandwidth=None):
+        if start is not None:
+            start, error = self._download_range(path, file, start, end,
+                                                bandwidth)
+            return (path, start), error
+        try:
+            code, content = self.read(path, stream=True, bandwidth=bandwidth)
+            if code != requests.codes.ok:
+                return path, code
+            with open(file, 'wb') as f:
+                for c in content:
+                    f.write(c)
+        except (IOError, requests.RequestException) as e:
+            return path, e
+        return path, None
+
+    def _download_range(self, path, file, start, end, bandwidth=None):
+        # ranges are written in place at their own offset, never joined
+        # in memory.
+        try:
+            code, content = self.read(path, range=(start, end), stream=True,
+                                      bandwidth=bandwidth)
+            if code != requests.codes.partial:
+                return start, code
+            with open(file, 'r+b') as f:
+                f.seek(start)
+                for c in content:
+                    f.write(c)
+                if f.tell() != end + 1:
+                    return start, 'short read at %d' % f.tell()
+        except (IOError, requests.RequestException) as e:
+            return start, e
+        return start, None
+
+    def _ranges(self, file, meta, resume):
+        # preallocate (or reopen) the target and return every range, the
+        # ranges still missing and the resume state if any.
+        size = meta['size']
+        state = None
+        if resume:
+            state = DownloadState(file, size, meta.get('md5'), self.chunksize)
+        if state is None or not state.resumed:
+            with open(file, 'wb') as f:
+                f.truncate(size)
+
+        ranges = [(start, min(start + self.chunksize, size) - 1)
+                  for start in xrange(0, size, self.chunksize)]
+        pending = [r for r in ranges if state is None or not state.done(r[0])]
+        self._track('download', file, size,
+                    size - sum(end + 1 - start for start, end in pending))
+        return ranges, pending, state
+
+    def _download_ranges(self, path, file, meta, workers, resume,
+                         bandwidth=None):
+        ranges, pending, state = self._ranges(file, meta, resume)
+
+        def fetch(r):
+            return self._download_range(path, file, *r, bandwidth=bandwidth)
+
+        errors = {}
+        pool = ThreadPool(workers) if workers > 1 else None
+        try:
+            results = pool.imap_unordered(fetch, pending) if pool \
+                else itertools.imap(fetch, pending)
+            for start, error in results:
+                if error is not None:
+                    errors[start] = error
+                    continue
+                if state is not None:
+                    state.mark(start)
+                if self.transfers:
+                    self._advance('download', file,
+                                  min(self.chunksize, meta['size'] - start))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        if errors:
+            raise DownloadError('%d of %d ranges failed' % (len(errors),
+                                                            len(ranges)),
+                                errors)
+        if state is not None:
+            state.discard()
 
     def meta(self, path):
 
@@ -199,30 +994,26 @@ class Client(object):
                   'access_token': self.access_token,
                   'path': path}
 
-        r = requests.get(self.URI['file'],
-                         params=params)
-
-        return r.status_code, r.json()
+        return self._cached(('meta', path),
+                            lambda: self._call('GET', self.URI['file'],
+                                               params=params))
 
     def _meta_multi(self, path):
         l = [{'path': f} for f in path]
         params = {'method': 'meta',
                   'access_token': self.access_token}
 
-        r = requests.post(self.URI['file'],
+        return self._call('POST', self.URI['file'],
                           params=params,
                           data={'param': json.dumps({'list': l})})
 
-        return r.status_code, r.json()
-
     def mkdir(self, path):
         params = {'method': 'mkdir',
                   'access_token': self.access_token,
                   'path': path}
-        r = requests.post(self.URI['file'],
-                          params=params)
-
-        return r.status_code, r.json()
+        return self._mutated(self._call('POST', self.URI['file'],
+                                        params=params),
+                             path)
 
     def list(self, path, by=None, order=None, limit=None):
         params = {'method': 'list',
@@ -234,9 +1025,53 @@ class Client(object):
             params['order'] = order
         if limit is not None:
             params['limit'] = limit
-        r = requests.get(self.URI['file'],
-                         params=params)
-        return r.status_code, r.json()
+        return self._cached(('list', path, by, order, limit),
+                            lambda: self._call('GET', self.URI['file'],
+                                               params=params))
+
+    def _pages(self, fetch, key, page, pool=None):
+        ''' Yield the entries under key of fetch(start, limit) replies,
+        page by page, while the next page is already being fetched on
+        pool, a one-thread ThreadPool of its own unless given.
+        '''
+        own = pool is None
+        if own:
+            pool = ThreadPool(1)
+        try:
+            start = 0
+            pending = pool.apply_async(fetch, (start, page))
+            while True:
+                code, r = pending.get()
+                if code != requests.codes.ok:
+                    raise ListError('listing failed: %d %s' % (code, r),
+                                    code, r)
+                entries = r.get(key) or []
+                start += page
+                if len(entries) >= page:
+                    pending = pool.apply_async(fetch, (start, page))
+                for e in entries:
+                    yield e
+                if len(entries) < page:
+                    return
+        except GeneratorExit:
+            if own:
+                # the reader stopped early, no need to finish the prefetch
+                own = False
+                pool.terminate()
+            raise
+        finally:
+            if own:
+                pool.close()
+                pool.join()
+
+    def iter_list(self, path, by=None, order=None, page=None):
+        ''' Entries of directory path one by one, LIST_PAGE per request. '''
+        return self._pages(self._list_page(path, by, order), 'list',
+                           page or self.LIST_PAGE)
+
+    def _list_page(self, path, by=None, order=None):
+        return lambda start, limit: self.list(
+            path, by, order, limit='%d-%d' % (start, start + limit))
 
     def move(self, from_path, to_path):
         return self._op(method='move', from_path=from_path, to_path=to_path)
@@ -255,20 +1090,18 @@ class Client(object):
                   'access_token': self.access_token,
                   'from': from_path,
                   'to': to_path}
-        r = requests.post(self.URI['file'],
-                          params=params)
-
-        return r.status_code, r.json()
+        return self._mutated(self._call('POST', self.URI['file'],
+                                        params=params),
+                             from_path, to_path)
 
     def _op_multi(self, method, from_path, to_path):
         params = {'method': method, 'access_token': self.access_token}
         l = {'list': [{'from': f, 'to': t}
                       for f, t in zip(from_path, to_path)]}
-        r = requests.post(self.URI['file'],
-                          params=params,
-                          data={'param': json.dumps(l)})
-
-        return r.status_code, r.json()
+        return self._mutated(self._call('POST', self.URI['file'],
+                                        params=params,
+                                        data={'param': json.dumps(l)}),
+                             *(from_path + to_path))
 
     def search(self, path, wd, re=0):
         params = {'method': 'search',
@@ -276,31 +1109,94 @@ class Client(object):
                   'path': path,
                   'wd': wd,
                   're': str(re)}
-        r = requests.get(self.URI['file'],
-                         params=params)
-
-        return r.status_code, r.json()
+        return self._call('GET', self.URI['file'],
+                          params=params)
 
-    def thumbnail(self, path, width, height, quality=100):
+    def thumbnail(self, path, width, height, quality=100, version=None):
+        ''' version is the file's md5 (or mtime) for thumbnail_cache; it is
+        looked up with meta when not given.
+        '''
+        if self.thumbnail_cache is None:
+            return self._thumbnail(path, width, height, quality)
+        if version is None:
+            code, r = self.meta(path)
+            if code != requests.codes.ok:
+                return code, r
+            version = file_version(r['list'][0])
+        key = thumbnail_key(path, width, height, quality, version)
+        content = self.thumbnail_cache.get(key)
+        if content is not None:
+            return self._reply((requests.codes.ok, content))
+
+        def store(result):
+            if result[0] == requests.codes.ok:
+                self.thumbnail_cache.put(key, result[1])
+        return self._then(self._thumbnail(path, width, height, quality),
+                          store)
+
+    def _thumbnail(self, path, width, height, quality):
         params = {'method': 'generate',
                   'access_token': self.access_token,
                   'path': path,
                   'width': int(width),
                   'height': int(height),
                   'quality': int(quality)}
-        r = requests.get(self.URI['thumbnail'],
-                         params=params)
-
-        return r.status_code, r.content
+        return self._call('GET', self.URI['thumbnail'],
+                          params=params,
+                          result='content')
+
+    def prefetch_thumbnails(self, entries, width, height, quality=100,
+                            workers=8):
+        ''' Warm thumbnail_cache for entries, e.g. the 'list' of a
+        stream_list(type='image') page, workers at a time. Returns
+        {'fetched', 'cached', 'failed'} counts.
+        '''
+        counts, todo = self._thumbnails_todo(entries, width, height, quality)
+
+        def fetch(e):
+            # one failed image must not cost the rest of the page
+            try:
+                return self.thumbnail(e['path'], width, height, quality,
+                                      file_version(e))[0]
+            except (EnvironmentError, requests.RequestException):
+                return None
+
+        if todo:
+            pool = ThreadPool(min(workers, len(todo)))
+            try:
+                for code in pool.imap_unordered(fetch, todo):
+                    if code == requests.codes.ok:
+                        counts['fetched'] += 1
+                    else:
+                        counts['failed'] += 1
+            finally:
+                pool.close()
+                pool.join()
+        return counts
+
+    def _thumbnails_todo(self, entries, width, height, quality):
+        # counts with the cached images tallied, and the entries to fetch
+        if self.thumbnail_cache is None:
+            raise ValueError('prefetch_thumbnails needs a thumbnail_cache')
+        counts = {'fetched': 0, 'cached': 0, 'failed': 0}
+        todo = []
+        for e in entries:
+            if e.get('isdir'):
+                continue
+            key = thumbnail_key(e['path'], width, height, quality,
+                                file_version(e))
+            if self.thumbnail_cache.contains(key):
+                counts['cached'] += 1
+            else:
+                todo.append(e)
+        return counts, todo
 
     def diff(self, cursor='null'):
         params = {'method': 'diff',
                   'access_token': self.access_token,
                   'cursor': cursor}
-        r = requests.get(self.URI['file'],
-                         params=params)
-
-        return r.status_code, r.json()
+        return self._call('GET', self.URI['file'],
+                          params=params)
 
     def streaming(self, path, type='M3U8_320_240', stream=False,
                   bucksize=64 * 1024):
@@ -308,14 +1204,17 @@ class Client(object):
                   'access_token': self.access_token,
                   'path': path,
                   'type': type}
-        r = requests.get(self.URI['file'],
-                         params=params,
-                         stream=stream)
+        return self._call('GET', self.URI['file'],
+                          params=params,
+                          result=stream and 'stream' or 'content',
+                          bucksize=bucksize)
 
-        if stream:
-            return r.status_code, r.iter_content(bucksize)
-        else:
-            return r.status_code, r.content
+    def stream_segments(self, path, type='M3U8_320_240', prefetch=4,
+                        bandwidth=None):
+        ''' The segments of path's playlist with the next prefetch ones
+        downloading ahead, see SegmentStream.
+        '''
+        return SegmentStream(self, path, type, prefetch, bandwidth)
 
     def stream_list(self, type='image', start=0, limit=1000, filter_path=None):
         params = {'method': 'list',
@@ -325,23 +1224,25 @@ class Client(object):
                   'limit': str(limit)}
         if filter_path is not None:
             params['filter_path'] = filter_path
-        r = requests.get(self.URI['stream'],
-                         params=params)
+        return self._call('GET', self.URI['stream'],
+                          params=params)
 
-        return r.status_code, r.json()
+    def iter_stream_list(self, type='image', filter_path=None, page=1000):
+        return self._pages(
+            lambda start, limit: self.stream_list(type, start, limit,
+                                                  filter_path),
+            'list', page)
 
-    def stream_download(self, path, stream=False, bucksize=64 * 1024):
+    def stream_download(self, path, stream=False, bucksize=64 * 1024,
+                        bandwidth=None):
         params = {'method': 'download',
                   'access_token': self.access_token,
                   'path': path}
-        r = requests.get(self.URI['stream'],
-                         params=params,
-                         stream=stream)
-
-        if stream:
-            return r.status_code, r.iter_content(bucksize)
-        else:
-            return r.status_code, r.content
+        return self._call('GET', self.URI['stream'],
+                          params=params,
+                          result=stream and 'stream' or 'content',
+                          bucksize=bucksize,
+                          bandwidth=bandwidth)
 
     def rapid_upload(self, path, content_legnth, content_md5, slice_md5,
                      content_crc32, ondup='overwrite'):
@@ -353,27 +1254,16 @@ class Client(object):
                   'slice-md5': slice_md5,
                   'content-crc32': content_crc32,
                   'ondup': ondup}
-        r = requests.post(self.URI['file'],
-                          params=params)
-
-        return r.status_code, r.json()
+        return self._mutated(self._call('POST', self.URI['file'],
+                                        params=params),
+                             path)
 
     def rapid_upload_file(self, path, file, ondup='overwrite'):
-        with open(file, 'rb') as f:
-            md5 = hashlib.md5()
-            slice_md5 = None
-            crc = None
-            for chunk in iter(lambda: f.read(256 * 1024L), b''):
-                md5.update(chunk)
-                if slice_md5 is None:
-                    slice_md5 = md5.hexdigest()
-                if crc is None:
-                    crc = binascii.crc32(chunk)
-                else:
-                    crc = binascii.crc32(chunk, crc)
-            content_md5 = md5.hexdigest()
-            content_crc32 = '%08x' % (crc & 0xffffffff)
-            content_length = str(f.tell())
+        if self.digest_cache is not None:
+            digests = self.digest_cache.digests(file)
+        else:
+            digests = file_digests(file)
+        content_length, content_md5, slice_md5, content_crc32 = digests
 
         return self.rapid_upload(path,
                                  content_length,
@@ -396,11 +1286,9 @@ class Client(object):
             params['callback'] = callback
         if expires is not None:
             params['expires'] = int(expires)
-        r = requests.post(self.URI['cloud_dl'],
+        return self._call('POST', self.URI['cloud_dl'],
                           params=params)
 
-        return r.status_code, r.json()
-
     def query_task(self, task_ids, op_type=1, expires=None):
         params = {'method': 'query_task',
                   'access_token': self.access_token,
@@ -410,11 +1298,9 @@ class Client(object):
         params['task_ids'] = str(task_ids)
         if expires is not None:
             params['expires'] = int(expires)
-        r = requests.post(self.URI['cloud_dl'],
+        return self._call('POST', self.URI['cloud_dl'],
                           params=params)
 
-        return r.status_code, r.json()
-
     def list_task(self, expires=None, start=0, limit=10, asc=0,
                   source_url=None, save_path=None, create_time=None,
                   status=None, need_task_info=1):
@@ -434,10 +1320,15 @@ class Client(object):
             params['create_time'] = int(create_time)
         if status is not None:
             params['status'] = int(status)
-        r = requests.post(self.URI['cloud_dl'],
+        return self._call('POST', self.URI['cloud_dl'],
                           params=params)
 
-        return r.status_code, r.json()
+    def iter_tasks(self, page=100, **kwargs):
+        ''' Every task's info, taking the filters of list_task. '''
+        return self._pages(
+            lambda start, limit: self.list_task(start=start, limit=limit,
+                                                **kwargs),
+            'task_info', page)
 
     def cancel_task(self, task_id, expires=None):
         params = {'method': 'cancel_task',
@@ -445,18 +1336,17 @@ class Client(object):
                   'task_id': task_id}
         if expires is not None:
             params['expires'] = int(expires)
-        r = requests.post(self.URI['cloud_dl'], params=params)
-
-        return r.status_code, r.json()
+        return self._call('POST', self.URI['cloud_dl'], params=params)
 
     def list_recycle(self, start=0, limit=1000):
         params = {'method': 'listrecycle',
                   'access_token': self.access_token,
                   'start': start,
                   'limit': limit}
-        r = requests.get(self.URI['file'], params=params)
+        return self._call('GET', self.URI['file'], params=params)
 
-        return r.status_code, r.json()
+    def iter_recycle(self, page=1000):
+        return self._pages(self.list_recycle, 'list', page)
 
     def restore_recycle(self, fs_id):
         params = {'method': 'restore',
@@ -467,14 +1357,12 @@ class Client(object):
         else:
             params['fs_id'] = str(fs_id)
 
-        r = requests.post(self.URI['file'], params=params, data=data)
-
-        return r.status_code, r.json()
+        # the restored paths are unknown here, so drop the whole cache
+        return self._mutated(self._call('POST', self.URI['file'],
+                                        params=params, data=data))
 
     def empty_recycle(self):
         params = {'method': 'delete',
                   'access_token': self.access_token,
                   'type': 'recycle'}
-        r = requests.post(self.URI['file'], params=params)
-
-        return r.status_code, r.json()
+        return self._call('POST', self.URI['file'], params=params)
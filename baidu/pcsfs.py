@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+''' fsspec-style filesystem over Client, for the "pcs" protocol.
+
+PCSFileSystem follows fsspec's AbstractFileSystem interface (ls, info,
+cat_file, cat_ranges, open, put_file, get_file, rm_file, mkdir, mv,
+cp_file and a dircache of listings) and subclasses it when fsspec can
+be imported; otherwise it stands alone with the same methods.
+'''
+import errno
+import posixpath
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+from baidu.pcs import Client, ListError
+
+try:
+    from fsspec import AbstractFileSystem, register_implementation
+except ImportError:
+    AbstractFileSystem = object
+    register_implementation = None
+
+
+UPLOAD_OPTIONS = ('ondup', 'workers', 'rapid', 'rapid_min_size', 'bandwidth')
+DOWNLOAD_OPTIONS = ('workers', 'resume', 'bandwidth')
+
+
+def _options(kwargs, names):
+    return dict((k, v) for k, v in kwargs.items() if k in names)
+
+
+def _missing(path):
+    return IOError(errno.ENOENT, 'no such file or directory', path)
+
+
+class PCSFileSystem(AbstractFileSystem):
+
+    protocol = 'pcs'
+    root_marker = '/'
+
+    def __init__(self, access_token=None, client=None, max_workers=8,
+                 block_size=1024 * 1024, **kwargs):
+        if AbstractFileSystem is not object:
+            super(PCSFileSystem, self).__init__(**kwargs)
+        else:
+            self.dircache = {}
+        self.client = client or Client(access_token)
+        self.max_workers = max_workers
+        self.block_size = block_size
+
+    @classmethod
+    def _strip_protocol(cls, path):
+        if path.startswith('pcs://'):
+            path = path[len('pcs://'):]
+        return '/' + path.strip('/')
+
+    def _entry(self, meta):
+        return {'name': meta['path'],
+                'size': meta.get('size', 0),
+                'type': meta.get('isdir') and 'directory' or 'file',
+                'md5': meta.get('md5'),
+                'fs_id': meta.get('fs_id'),
+                'mtime': meta.get('mtime')}
+
+    def ls(self, path, detail=True, refresh=False, **kwargs):
+        path = self._strip_protocol(path)
+        if refresh or path not in self.dircache:
+            try:
+                entries = [self._entry(e)
+                           for e in self.client.iter_list(path)]
+            except ListError:
+                # listing a file fails; fsspec lists it as itself
+                info = self.info(path)
+                if info['type'] == 'file':
+                    return [info] if detail else [path]
+                raise
+            self.dircache[path] = entries
+        entries = self.dircache[path]
+        return entries if detail else [e['name'] for e in entries]
+
+    def info(self, path, **kwargs):
+        path = self._strip_protocol(path)
+        if path == '/':
+            return {'name': '/', 'size': 0, 'type': 'directory'}
+        # a cached listing of the parent answers without a round trip
+        for e in self.dircache.get(posixpath.dirname(path)) or ():
+            if e['name'] == path:
+                return e
+        code, r = self.client.meta(path)
+        if code != requests.codes.ok:
+            raise _missing(path)
+        return self._entry(r['list'][0])
+
+    def exists(self, path, **kwargs):
+        try:
+            self.info(path)
+            return True
+        except IOError:
+            return False
+
+    def isdir(self, path):
+        try:
+            return self.info(path)['type'] == 'directory'
+        except IOError:
+            return False
+
+    def isfile(self, path):
+        try:
+            return self.info(path)['type'] == 'file'
+        except IOError:
+            return False
+
+    def cat_file(self, path, start=None, end=None, **kwargs):
+        ''' Bytes start to end (exclusive) of path; negative offsets count
+        from the end as in fsspec.
+        '''
+        path = self._strip_protocol(path)
+        if (start is not None and start < 0) or (end is not None and end < 0):
+            size = self.info(path)['size']
+            if start is not None and start < 0:
+                start = max(0, size + start)
+            if end is not None and end < 0:
+                end = max(0, size + end)
+        start = start or 0
+        if end is not None and end <= start:
+            return b''
+        byte_range = None
+        if end is not None:
+            byte_range = (start, end - 1)
+        elif start:
+            byte_range = (start,)
+        code, content = self.client.read(path, range=byte_range)
+        if code == requests.codes.not_found:
+            raise _missing(path)
+        if code == requests.codes.ok and byte_range:
+            # the server ignored the range
+            content = content[start:]
+        elif code != requests.codes.partial and code != requests.codes.ok:
+            raise IOError('read %s failed: %d' % (path, code))
+        if end is not None:
+            # 'bytes=0-0' reads as an open range, so trim to the request
+            content = content[:end - start]
+        return content
+
+    def cat_ranges(self, paths, starts, ends, max_gap=None,
+                   on_error='return', **kwargs):
+        ''' Fetch every (path, start, end) range, max_workers at a time;
+        with on_error='return' a failed range yields its exception.
+        '''
+        def fetch(args):
+            try:
+                return self.cat_file(*args)
+            except Exception as e:
+                if on_error == 'raise':
+                    raise
+                return e
+
+        if isinstance(starts, (int, long)):
+            starts = [starts] * len(paths)
+        if isinstance(ends, (int, long)) or ends is None:
+            ends = [ends] * len(paths)
+        pool = ThreadPool(max(1, min(self.max_workers, len(paths))))
+        try:
+            return pool.map(fetch, zip(paths, starts, ends))
+        finally:
+            pool.close()
+            pool.join()
+
+    def _open(self, path, mode='rb', block_size=None, **kwargs):
+        if mode != 'rb':
+            raise NotImplementedError('PCS files are opened read-only; '
+                                      'use put_file to write')
+        path = self._strip_protocol(path)
+        return self.client.open(path, size=self.info(path)['size'],
+                                block_size=block_size or self.block_size)
+
+    if AbstractFileSystem is object:
+        def open(self, path, mode='rb', block_size=None, **kwargs):
+            return self._open(path, mode, block_size, **kwargs)
+
+    def _invalidate(self, *paths):
+        for path in paths:
+            path = self._strip_protocol(path)
+            self.dircache.pop(path, None)
+            self.dircache.pop(posixpath.dirname(path), None)
+
+    def invalidate_cache(self, path=None):
+        if path is None:
+            self.dircache.clear()
+        else:
+            self._invalidate(path)
+
+    def put_file(self, lpath, rpath, **kwargs):
+        # fsspec passes its own options (callback, ...) along; keep ours
+        code, r = self.client.upload(self._strip_protocol(rpath), lpath,
+                                     **_options(kwargs, UPLOAD_OPTIONS))
+        if code != requests.codes.ok:
+            raise IOError('upload %s failed: %d %s' % (rpath, code, r))
+        self._invalidate(rpath)
+
+    def get_file(self, rpath, lpath, **kwargs):
+        self.client.download(self._strip_protocol(rpath), lpath,
+                             **_options(kwargs, DOWNLOAD_OPTIONS))
+
+    def _checked(self, result, *paths):
+        code, r = result
+        if code != requests.codes.ok:
+            raise IOError('%s failed: %d %s' % (' '.join(paths), code, r))
+        self._invalidate(*paths)
+
+    def rm_file(self, path):
+        self._checked(self.client.delete(self._strip_protocol(path)), path)
+
+    def rm(self, path, recursive=False, **kwargs):
+        # a PCS delete always takes the whole subtree
+        paths = isinstance(path, (list, tuple)) and path or [path]
+        for p in paths:
+            self.rm_file(p)
+
+    def mkdir(self, path, create_parents=True, **kwargs):
+        self._checked(self.client.mkdir(self._strip_protocol(path)), path)
+
+    def makedirs(self, path, exist_ok=False):
+        if self.exists(path):
+            if not exist_ok:
+                raise IOError(errno.EEXIST, 'file exists', path)
+            return
+        self.mkdir(path)
+
+    def mv(self, path1, path2, **kwargs):
+        self._checked(self.client.move(self._strip_protocol(path1),
+                                       self._strip_protocol(path2)),
+                      path1, path2)
+
+    def cp_file(self, path1, path2, **kwargs):
+        self._checked(self.client.copy(self._strip_protocol(path1),
+                                       self._strip_protocol(path2)),
+                      path1, path2)
+
+
+if register_implementation is not None:
+    register_implementation('pcs', PCSFileSystem)
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+import time
+import random
+import threading
+
+import requests
+from requests.packages.urllib3.exceptions import NewConnectionError
+
+
+class TokenBucket(object):
+    ''' rate tokens per second, holding at most burst of them. '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def try_acquire(self, tokens=1):
+        with self.lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+    def reserve(self, tokens=1):
+        ''' Take the tokens now, going into debt if needed, and return the
+        seconds to wait before using them; waiters queue up fairly.
+        '''
+        with self.lock:
+            self._refill()
+            self.tokens -= tokens
+            return max(0, -self.tokens / self.rate)
+
+    def acquire(self, tokens=1):
+        # the debt is slept off outside the lock
+        wait = self.reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    @property
+    def available(self):
+        with self.lock:
+            self._refill()
+            return self.tokens
+
+
+class RateLimiter(object):
+    ''' One TokenBucket per endpoint of Client.URI ('file', 'quota',
+    'stream', 'cloud_dl', ...). rate and burst apply to every endpoint
+    unless rates maps its name to a (rate, burst) pair.
+    '''
+
+    def __init__(self, rate=10, burst=None, rates=None):
+        self.rate = rate
+        self.burst = burst
+        self.rates = rates or {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def bucket(self, endpoint):
+        with self.lock:
+            if endpoint not in self.buckets:
+                rate, burst = self.rates.get(endpoint,
+                                             (self.rate, self.burst))
+                self.buckets[endpoint] = TokenBucket(rate, burst)
+            return self.buckets[endpoint]
+
+    def acquire(self, endpoint):
+        self.bucket(endpoint).acquire()
+
+    def reserve(self, endpoint):
+        return self.bucket(endpoint).reserve()
+
+    def try_acquire(self, endpoint):
+        return self.bucket(endpoint).try_acquire()
+
+    def state(self):
+        ''' {endpoint: {'rate', 'burst', 'available'}} for every endpoint
+        used so far; available is negative while callers are queued.
+        '''
+        with self.lock:
+            buckets = self.buckets.items()
+        return dict((name, {'rate': b.rate,
+                            'burst': b.burst,
+                            'available': b.available})
+                    for name, b in buckets)
+
+
+def _unsent(error):
+    # true when the request never left: the connection was not made
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args and error.args[0], 'reason', None)
+    return isinstance(reason, NewConnectionError)
+
+
+class RetryPolicy(object):
+    ''' Which replies to retry and how long to wait before each attempt.
+
+    Connection errors, timeouts, 429/5xx statuses and the PCS frequency
+    control error are retried; anything else is final. A call that is
+    not idempotent is only retried when it cannot have been applied: the
+    connection was never made, or the server refused it with 429 or the
+    frequency control error. Waits are drawn
+    uniformly from [0, min(cap, base * 2 ** attempt)] so retrying clients
+    spread out. Every first attempt adds budget_ratio to a retry budget
+    (at most max_budget) and every retry spends one, so retries stay a
+    fraction of the traffic when the service is down.
+    '''
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+    # error_code of PCS "hit frequency control" replies
+    RETRY_ERROR_CODES = (31034,)
+
+    def __init__(self, max_retries=3, base=0.5, cap=30, budget_ratio=0.1,
+                 max_budget=10):
+        self.max_retries = max_retries
+        self.base = base
+        self.cap = cap
+        self.budget_ratio = budget_ratio
+        self.max_budget = max_budget
+        self.budget = float(max_budget)
+        self.retries = 0
+        self.exhausted = 0
+        self.lock = threading.Lock()
+
+    def retryable(self, response, error, idempotent=True):
+        if error is not None:
+            if not idempotent:
+                return _unsent(error)
+            return isinstance(error, (requests.ConnectionError,
+                                      requests.Timeout))
+        if response.status_code == 429:
+            return True
+        if idempotent and response.status_code in self.RETRY_STATUS:
+            return True
+        if response.status_code >= 400:
+            try:
+                code = response.json().get('error_code')
+            except ValueError:
+                return False
+            return code in self.RETRY_ERROR_CODES
+        return False
+
+    def attempted(self):
+        with self.lock:
+            self.budget = min(self.max_budget,
+                              self.budget + self.budget_ratio)
+
+    def should_retry(self, attempt, response, error, idempotent=True):
+        if attempt >= self.max_retries or \
+                not self.retryable(response, error, idempotent):
+            return False
+        with self.lock:
+            if self.budget < 1:
+                self.exhausted += 1
+                return False
+            self.budget -= 1
+            self.retries += 1
+            return True
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    def state(self):
+        with self.lock:
+            return {'budget': self.budget,
+                    'retries': self.retries,
+                    'exhausted': self.exhausted}
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import io
+from collections import OrderedDict
+
+import requests
+
+
+class RemoteFile(io.RawIOBase):
+    ''' Read-only, seekable file over ranged Client.read calls.
+
+    The file is read in blocks of block_size bytes, the last max_blocks
+    of which are kept in an LRU cache. A miss fetches the missing block
+    and up to readahead - 1 following ones in a single request;
+    readahead doubles (up to max_readahead) while reads stay sequential
+    and drops back to one block on a seek elsewhere, so scattered header
+    reads stay small and streaming reads use few large requests.
+
+    Wrap it in io.BufferedReader for readline() and small-read buffering.
+    Reads block on the client, so it needs a Client, not an AsyncClient.
+    '''
+
+    def __init__(self, client, path, size=None, block_size=256 * 1024,
+                 max_blocks=64, max_readahead=16):
+        super(RemoteFile, self).__init__()
+        self.client = client
+        self.path = path
+        if size is None:
+            code, r = client.meta(path)
+            if code != requests.codes.ok:
+                raise IOError('meta %s failed: %d %s' % (path, code, r))
+            size = r['list'][0]['size']
+        self.size = size
+        self.block_size = block_size
+        self.max_blocks = max(max_blocks, max_readahead)
+        self.max_readahead = max_readahead
+        self.blocks = OrderedDict()
+        self.position = 0
+        self.readahead = 1
+        self.last_block = None
+        self.requests = 0
+        self.hits = 0
+        self.misses = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise IOError('negative seek position %d' % offset)
+        self.position = offset
+        return offset
+
+    def readinto(self, b):
+        n = min(len(b), max(0, self.size - self.position))
+        done = 0
+        while done < n:
+            index, offset = divmod(self.position, self.block_size)
+            data = self._block(index)
+            chunk = data[offset:offset + n - done]
+            b[done:done + len(chunk)] = chunk
+            done += len(chunk)
+            self.position += len(chunk)
+        return done
+
+    def _block(self, index):
+        data = self.blocks.pop(index, None)
+        if data is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            if self.last_block is not None and index == self.last_block + 1:
+                self.readahead = min(self.max_readahead, self.readahead * 2)
+            elif index != self.last_block:
+                self.readahead = 1
+            self._fetch(index)
+            data = self.blocks.pop(index)
+        self.blocks[index] = data
+        self.last_block = index
+        return data
+
+    def _fetch(self, first):
+        last = first + 1
+        end = (self.size + self.block_size - 1) / self.block_size
+        while last < min(first + self.readahead, end) and \
+                last not in self.blocks:
+            last += 1
+        start = first * self.block_size
+        stop = min(last * self.block_size, self.size) - 1
+        code, content = self.client.read(self.path, range=(start, stop))
+        self.requests += 1
+        if code not in (requests.codes.ok, requests.codes.partial):
+            raise IOError('read %s failed: %d' % (self.path, code))
+        if code == requests.codes.ok:
+            # the server ignored the range
+            content = content[start:stop + 1]
+        for index in xrange(first, last):
+            offset = (index - first) * self.block_size
+            self.blocks[index] = content[offset:offset + self.block_size]
+        while len(self.blocks) > self.max_blocks:
+            self.blocks.popitem(last=False)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+from baidu.ratelimit import TokenBucket
+
+# largest piece of a body passed between two throttle checks
+QUANTUM = 16 * 1024
+
+
+class Bandwidth(object):
+    ''' Caps the bytes per second of every transfer sharing it; rate None
+    means unlimited.
+
+    Transfers call consume() for each piece of at most QUANTUM bytes they
+    send or receive, so traffic is paced within a block instead of
+    sleeping between whole blocks. set_rate() takes effect at once,
+    including for transfers already running.
+    '''
+
+    def __init__(self, rate=None):
+        self.lock = threading.Lock()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.rate = rate
+            # a tenth of a second of burst, but never less than one piece
+            self.bucket = rate and TokenBucket(rate, max(QUANTUM,
+                                                         rate / 10.0))
+
+    def consume(self, n):
+        bucket = self.bucket
+        if bucket:
+            bucket.acquire(n)
+
+    def reserve(self, n):
+        ''' consume() for callers that cannot block: the seconds to wait
+        before sending n more bytes.
+        '''
+        bucket = self.bucket
+        return bucket and bucket.reserve(n) or 0
+
+
+# shared by every Client that is not given a Bandwidth of its own
+GLOBAL = Bandwidth()
+
+
+def bandwidth(value):
+    ''' A Bandwidth for value: a Bandwidth, bytes per second or None. '''
+    if value is None or isinstance(value, Bandwidth):
+        return value
+    return Bandwidth(value)
+
+
+def throttled(chunks, throttles):
+    for chunk in chunks:
+        for t in throttles:
+            t.consume(len(chunk))
+        yield chunk
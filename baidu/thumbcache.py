@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import hashlib
+import sqlite3
+import tempfile
+import threading
+
+
+def thumbnail_key(path, width, height, quality, version):
+    ''' version is the file's md5, or its mtime where no md5 is known, so
+    a changed file never hits the thumbnail of its old content.
+    '''
+    return '%s\0%d\0%d\0%d\0%s' % (path, int(width), int(height),
+                                   int(quality), version)
+
+
+def file_version(meta):
+    ''' The version of a meta, list or stream_list entry. '''
+    return meta.get('md5') or str(meta.get('mtime'))
+
+
+class ThumbnailCache(object):
+    ''' Persistent, size-bounded cache of thumbnail images.
+
+    Images are stored as one file each under directory, named by the
+    sha1 of their key; a sqlite index keeps their sizes and last access
+    times. When more than max_bytes are stored, the least recently used
+    images are evicted down to nine tenths of the limit.
+    '''
+
+    def __init__(self, directory=None, max_bytes=256 * 1024 * 1024):
+        if directory is None:
+            directory = os.path.join(os.path.expanduser('~'), '.baidu-pcs',
+                                     'thumbnails')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(directory, 'index.db'),
+                                  check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS thumbnails ('
+                        'name TEXT PRIMARY KEY, size INTEGER, atime REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS thumbnails_atime '
+                        'ON thumbnails (atime)')
+        self.db.commit()
+        self.bytes = self.db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM thumbnails').fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    def _name(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return hashlib.sha1(key).hexdigest()
+
+    def contains(self, key):
+        # no atime update, so prefetching does not reorder the LRU
+        return os.path.exists(os.path.join(self.directory, self._name(key)))
+
+    def get(self, key):
+        name = self._name(key)
+        try:
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                content = f.read()
+        except IOError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+            self.db.execute('UPDATE thumbnails SET atime = ? WHERE name = ?',
+                            (time.time(), name))
+            self.db.commit()
+        return content
+
+    def put(self, key, content):
+        name = self._name(key)
+        # written aside and renamed, so readers never see half an image
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.rename(tmp, os.path.join(self.directory, name))
+        with self.lock:
+            row = self.db.execute('SELECT size FROM thumbnails '
+                                  'WHERE name = ?', (name,)).fetchone()
+            self.bytes += len(content) - (row and row[0] or 0)
+            self.db.execute('INSERT OR REPLACE INTO thumbnails '
+                            'VALUES (?, ?, ?)',
+                            (name, len(content), time.time()))
+            if self.bytes > self.max_bytes:
+                self._evict(self.max_bytes * 9 / 10)
+            self.db.commit()
+
+    def _evict(self, target):
+        rows = self.db.execute('SELECT name, size FROM thumbnails '
+                               'ORDER BY atime').fetchall()
+        for name, size in rows:
+            if self.bytes <= target:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            self.db.execute('DELETE FROM thumbnails WHERE name = ?', (name,))
+            self.bytes -= size
+
+    def close(self):
+        self.db.close()
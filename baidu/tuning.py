@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from collections import deque
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) / 2]
+
+
+class UploadTuner(object):
+    ''' Picks block size and concurrency of multi-part uploads from the
+    blocks sent so far.
+
+    Each block is timed in two parts: sending its body, which gives the
+    per-connection throughput, and waiting for the reply once the body
+    is out, which gives the round trip plus the server's per-block work.
+    Blocks are made large enough for that wait to stay under
+    overhead_ratio of a block's time, doubling from the client's size
+    and never past max_chunksize. Concurrency is hill-climbed: after
+    every round of as many blocks as there are workers, the aggregate
+    throughput decides whether to double the workers, keep them or fall
+    back to the previous count.
+    '''
+
+    def __init__(self, max_chunksize=256 * 1024 * 1024, max_workers=16,
+                 overhead_ratio=0.1, samples=32):
+        self.max_chunksize = max_chunksize
+        self.max_workers = max_workers
+        self.overhead_ratio = overhead_ratio
+        self.samples = deque(maxlen=samples)
+        self.lock = threading.Lock()
+        self.workers = 1
+        self.previous = 1
+        self.throughput = None
+        self.round_bytes = 0
+        self.round_blocks = 0
+        self.round_start = None
+
+    def chunksize(self, base, size):
+        ''' Block size for a file of size bytes whose smallest allowed
+        block size is base; the file always keeps at least two blocks.
+        '''
+        with self.lock:
+            if not self.samples:
+                return base
+            rate = _median([n / max(send, 1e-6)
+                            for n, send, w in self.samples])
+            wait = _median([w for n, send, w in self.samples])
+        want = rate * wait * (1 - self.overhead_ratio) / self.overhead_ratio
+        chunksize = base
+        while chunksize < want and chunksize * 2 <= self.max_chunksize \
+                and chunksize * 2 < size:
+            chunksize *= 2
+        return chunksize
+
+    def start(self):
+        # called when a file's blocks start going out
+        with self.lock:
+            self.round_start = time.time()
+            self.round_bytes = self.round_blocks = 0
+
+    def record(self, size, send, wait):
+        ''' A block of size bytes took send seconds to go out and wait
+        seconds more for its reply.
+        '''
+        with self.lock:
+            self.samples.append((size, send, wait))
+            self.round_bytes += size
+            self.round_blocks += 1
+            if self.round_blocks < self.workers:
+                return
+            now = time.time()
+            throughput = self.round_bytes / max(now - self.round_start, 1e-6)
+            if self.throughput is None or \
+                    throughput > self.throughput * 1.1:
+                self.previous = self.workers
+                self.workers = min(self.max_workers, self.workers * 2)
+            elif throughput < self.throughput * 0.9:
+                self.workers = self.previous
+            self.throughput = throughput
+            self.round_start = now
+            self.round_bytes = self.round_blocks = 0
+
+    def params(self):
+        with self.lock:
+            samples = list(self.samples)
+            result = {'workers': self.workers,
+                      'throughput': self.throughput}
+        if samples:
+            result['block_throughput'] = _median(
+                [n / max(send, 1e-6) for n, send, w in samples])
+            result['block_wait'] = _median([w for n, send, w in samples])
+        return result
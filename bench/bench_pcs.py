@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+''' ops/s and MB/s of upload, download, meta, list and batched meta
+against the local stand-in server of bench/pcs_server.py.
+
+    python bench/bench_pcs.py [--size 4194304] [--files 20] [--count 500]
+                              [--threads 4]
+                              [--latency 0.01] [--bandwidth 0]
+                              [--error-rate 0] [--lib DIR] [--json]
+    python bench/bench_pcs.py --compare DIR [options]
+
+--lib imports baidu from another checkout; --compare runs the suite once
+with this checkout and once with DIR (e.g. a `git worktree` of an older
+commit) under the same options and prints both side by side. Only calls
+present since the first release are used, so old versions can be
+measured as well.
+'''
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+OPS = ('upload', 'download', 'meta', 'list', 'batch_meta')
+
+
+def run_parallel(count, threads, op):
+    ''' Run op(i) for i in range(count) on threads; return (seconds,
+    failures).
+    '''
+    failures = [0]
+    lock = threading.Lock()
+    todo = iter(xrange(count))
+
+    def worker():
+        while True:
+            with lock:
+                i = next(todo, None)
+            if i is None:
+                return
+            try:
+                ok = op(i)
+            except Exception:
+                ok = False
+            if not ok:
+                with lock:
+                    failures[0] += 1
+
+    ts = [threading.Thread(target=worker) for i in range(threads)]
+    start = time.time()
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    return time.time() - start, failures[0]
+
+
+def suite(args):
+    sys.path.insert(0, args.lib)
+    sys.path.insert(0, HERE)
+    import baidu.pcs
+    from pcs_server import PCSServer
+
+    server = PCSServer(latency=args.latency,
+                       bandwidth=args.bandwidth or None,
+                       error_rate=args.error_rate).start()
+    client = baidu.pcs.Client('token')
+    client.URI = server.uri
+    client.chunksize = args.chunksize
+    workdir = tempfile.mkdtemp()
+    source = os.path.join(workdir, 'source')
+    with open(source, 'wb') as f:
+        f.write(os.urandom(args.size))
+    remote = '/apps/bench'
+    paths = ['%s/%d.bin' % (remote, i) for i in range(args.files)]
+
+    def ok(code):
+        return code in (200, 206)
+
+    results = {}
+
+    def record(name, ops, size, (seconds, failures)):
+        results[name] = {'ops': ops / seconds,
+                         'mb': size / seconds / 1024 / 1024,
+                         'seconds': seconds,
+                         'failures': failures}
+
+    record('upload', args.files, args.files * args.size, run_parallel(
+        args.files, args.threads,
+        lambda i: ok(client.upload(paths[i], source)[0])))
+
+    # later runs must not depend on what an injected error dropped
+    for path in paths:
+        server.state.put(path, open(source, 'rb').read())
+
+    def download(i):
+        target = os.path.join(workdir, 'download-%d' % i)
+        client.download(paths[i], target)
+        return os.path.getsize(target) == args.size
+    record('download', args.files, args.files * args.size,
+           run_parallel(args.files, args.threads, download))
+
+    record('meta', args.count, 0, run_parallel(
+        args.count, args.threads,
+        lambda i: ok(client.meta(paths[i % len(paths)])[0])))
+    record('list', args.count, 0, run_parallel(
+        args.count, args.threads, lambda i: ok(client.list(remote)[0])))
+
+    batch = (paths * (100 / args.files + 1))[:100]
+    record('batch_meta', args.count * len(batch), 0, run_parallel(
+        args.count, args.threads, lambda i: ok(client.meta(batch)[0])))
+
+    if hasattr(client, 'close'):
+        # older versions had no close()
+        client.close()
+    server.stop()
+    shutil.rmtree(workdir)
+    return results
+
+
+def child(args, lib):
+    # a fresh interpreter per checkout, so the two never share modules
+    argv = [sys.executable, os.path.abspath(__file__), '--json',
+            '--lib', lib]
+    for name in ('size', 'chunksize', 'files', 'count', 'threads', 'latency',
+                 'bandwidth', 'error_rate'):
+        argv += ['--' + name.replace('_', '-'), str(getattr(args, name))]
+    return json.loads(subprocess.check_output(argv))
+
+
+def show(columns):
+    names = [name for name, results in columns]
+    print '%-12s' % 'op' + ''.join('%22s' % n[-22:] for n in names)
+    for op in OPS:
+        cells = []
+        for name, results in columns:
+            r = results[op]
+            cell = '%9.1f ops/s' % r['ops']
+            if r['mb']:
+                cell = '%7.1f MB/s' % r['mb'] + ' %5.0f/s' % r['ops']
+            if r['failures']:
+                cell += ' !%d' % r['failures']
+            cells.append('%22s' % cell)
+        if len(columns) == 2:
+            a, b = columns[0][1][op]['ops'], columns[1][1][op]['ops']
+            cells.append('  %+6.1f%%' % ((a / b - 1) * 100 if b else 0))
+        print '%-12s' % op + ''.join(cells)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=4 * 1024 * 1024)
+    parser.add_argument('--chunksize', type=int, default=1024 * 1024)
+    parser.add_argument('--files', type=int, default=20,
+                        help='files uploaded and downloaded')
+    parser.add_argument('--count', type=int, default=500,
+                        help='meta, list and batch calls')
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='bytes per second per connection, 0 for none')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--lib', default=ROOT)
+    parser.add_argument('--compare')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    if args.compare:
+        show([(ROOT, child(args, ROOT)), (args.compare,
+                                          child(args, args.compare))])
+    elif args.json:
+        print json.dumps(suite(args))
+    else:
+        show([(args.lib, suite(args))])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+''' Requests/sec of Client.meta against a local stand-in server, with and
+without the pooled keep-alive session.
+
+    python bench/bench_session.py [--requests 2000] [--threads 4]
+'''
+import argparse
+import os
+import sys
+import threading
+import time
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class OneShotSession(object):
+    ''' The pre-pool behaviour: a fresh connection for every call. '''
+
+    def request(self, method, url, **kwargs):
+        return requests.request(method, url, **kwargs)
+
+    def close(self):
+        pass
+
+
+def run(client, count, threads):
+    def worker(n):
+        for i in range(n):
+            code, r = client.meta('/apps/bench/a.txt')
+            assert code == requests.codes.ok
+
+    per_thread = count / threads
+    ts = [threading.Thread(target=worker, args=(per_thread,))
+          for i in range(threads)]
+    start = time.time()
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    return per_thread * threads / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(HERE))
+    sys.path.insert(0, HERE)
+    import baidu.pcs
+    from pcs_server import PCSServer
+
+    server = PCSServer().start()
+    server.state.put('/apps/bench/a.txt', 'abc')
+
+    for name, session in [('no pool', OneShotSession()), ('pooled', None)]:
+        client = baidu.pcs.Client('token',
+                                  pool_maxsize=args.threads,
+                                  session=session)
+        client.URI = server.uri
+        rps = run(client, args.requests, args.threads)
+        client.close()
+        print '%-8s %8.1f req/s' % (name, rps)
+
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,499 @@
+# -*- coding: utf-8 -*-
+''' In-memory stand-in for the PCS endpoints Client talks to: file,
+quota, thumbnail, stream and cloud_dl.
+
+    server = PCSServer(latency=0.02, bandwidth=10 * 1024 * 1024,
+                       error_rate=0.01).start()
+    client = baidu.pcs.Client('token')
+    client.URI = server.uri
+    ...
+    server.stop()
+
+latency is added to every request, bandwidth (bytes per second) paces
+request and response bodies in 16 KB pieces, and error_rate is the share
+of requests answered with error_status and PCS error 31034 instead.
+'''
+import cgi
+import json
+import time
+import random
+import socket
+import hashlib
+import urlparse
+import StringIO
+import threading
+import posixpath
+import BaseHTTPServer
+import SocketServer
+
+ENDPOINTS = ('file', 'quota', 'thumbnail', 'stream', 'cloud_dl')
+PIECE = 16 * 1024
+SEGMENT_SIZE = 256 * 1024
+STREAM_TYPES = {'image': ('.jpg', '.jpeg', '.png', '.gif', '.bmp'),
+                'video': ('.mp4', '.avi', '.mkv', '.mov', '.flv'),
+                'audio': ('.mp3', '.wav', '.wma', '.flac'),
+                'doc': ('.doc', '.pdf', '.txt', '.xls', '.ppt')}
+
+
+class State(object):
+    ''' The remote tree: files maps path to content, dirs holds the paths
+    of directories, blocks the uploaded tmpfile blocks by md5. Only put()
+    should store files, as it also records their md5. log lists the path
+    of every entry added or removed, in order; diff cursors index it.
+    '''
+
+    def __init__(self, quota=2 * 1024 ** 4):
+        self.lock = threading.RLock()
+        self.quota = quota
+        self.files = {}
+        self.md5s = {}
+        self.dirs = set(['/'])
+        self.blocks = {}
+        self.ids = {}
+        self.recycle = {}
+        self.tasks = {}
+        self.log = []
+
+    @property
+    def changes(self):
+        return len(self.log)
+
+    def fs_id(self, path):
+        return self.ids.setdefault(path, abs(hash(path)) % 10 ** 12)
+
+    def meta(self, path):
+        if path in self.dirs:
+            return {'fs_id': self.fs_id(path), 'path': path, 'ctime': 1,
+                    'mtime': 1, 'block_list': '[]', 'size': 0, 'isdir': 1,
+                    'ifhassubdir': int(any(posixpath.dirname(d) == path
+                                           for d in self.dirs if d != path))}
+        md5 = self.md5s[path]
+        return {'fs_id': self.fs_id(path), 'path': path, 'ctime': 1,
+                'mtime': 1, 'md5': md5, 'size': len(self.files[path]),
+                'isdir': 0,
+                'block_list': json.dumps([md5])}
+
+    def exists(self, path):
+        return path in self.files or path in self.dirs
+
+    def mkdirs(self, path):
+        while path not in self.dirs:
+            self.dirs.add(path)
+            self.log.append(path)
+            path = posixpath.dirname(path)
+
+    def put(self, path, content, ondup='overwrite'):
+        if self.exists(path) and ondup == 'newcopy':
+            root, ext = posixpath.splitext(path)
+            path = '%s_%d%s' % (root, int(time.time() * 1000), ext)
+        self.mkdirs(posixpath.dirname(path))
+        self.files[path] = content
+        self.md5s[path] = hashlib.md5(content).hexdigest()
+        self.log.append(path)
+        return path
+
+    def subtree(self, path):
+        prefix = path.rstrip('/') + '/'
+        return [p for p in list(self.files) + list(self.dirs)
+                if p == path or p.startswith(prefix)]
+
+    def remove(self, path):
+        entries = self.subtree(path)
+        if not entries:
+            return False
+        if path in self.files or path in self.dirs:
+            self.recycle[self.fs_id(path)] = (path, dict(
+                (p, self.files[p]) for p in entries if p in self.files),
+                [p for p in entries if p in self.dirs])
+        for p in entries:
+            self.files.pop(p, None)
+            self.dirs.discard(p)
+        self.log.extend(entries)
+        return True
+
+    def copy(self, src, dst, move=False):
+        entries = self.subtree(src)
+        if not entries:
+            return False
+        for p in entries:
+            target = dst + p[len(src):]
+            if p in self.dirs:
+                self.mkdirs(target)
+            else:
+                self.put(target, self.files[p])
+        if move:
+            for p in entries:
+                self.files.pop(p, None)
+                self.dirs.discard(p)
+            self.log.extend(entries)
+        return True
+
+    def children(self, path):
+        path = path.rstrip('/') or '/'
+        return sorted(p for p in list(self.files) + list(self.dirs)
+                      if p != '/' and posixpath.dirname(p) == path)
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    # bodies over the write buffer leave in several segments; without
+    # this the tail waits for a delayed ACK on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_call('GET')
+
+    def do_POST(self):
+        self.handle_call('POST')
+
+    def handle_call(self, verb):
+        server = self.server
+        url = urlparse.urlparse(self.path)
+        query = dict((k, v[0]) for k, v in
+                     urlparse.parse_qs(url.query).items())
+        fields = self.read_fields()
+        endpoint = url.path.rstrip('/').split('/')[-1]
+        if server.latency:
+            time.sleep(server.latency)
+        if random.random() < server.error_rate:
+            return self.reply(server.error_status,
+                              {'error_code': 31034,
+                               'error_msg': 'hit frequency control'})
+        handler = getattr(self, 'on_%s_%s' % (endpoint,
+                                              query.get('method')), None)
+        if handler is None:
+            return self.reply(400, {'error_code': 31023,
+                                    'error_msg': 'param error'})
+        # replies are paced, so only build them under the lock
+        with server.state.lock:
+            reply = handler(server.state, query, fields)
+        self.reply(*reply)
+
+    def read_fields(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        pieces = []
+        while length > 0:
+            piece = self.rfile.read(min(PIECE, length))
+            if not piece:
+                break
+            length -= len(piece)
+            pieces.append(piece)
+            self.pace(len(piece))
+        body = ''.join(pieces)
+        ctype = self.headers.get('Content-Type', '')
+        if ctype.startswith('multipart/form-data'):
+            kind, params = cgi.parse_header(ctype)
+            fields = cgi.parse_multipart(StringIO.StringIO(body),
+                                         {'boundary': params['boundary']})
+            return dict((k, v[0]) for k, v in fields.items())
+        return dict((k, v[0]) for k, v in urlparse.parse_qs(body).items())
+
+    def pace(self, n):
+        if self.server.bandwidth:
+            time.sleep(float(n) / self.server.bandwidth)
+
+    def reply(self, code, body, content_type='application/json',
+              headers=None):
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        for i in xrange(0, len(body), PIECE):
+            self.wfile.write(body[i:i + PIECE])
+            self.pace(min(PIECE, len(body) - i))
+
+    def missing(self):
+        return (404, {'error_code': 31066,
+                      'error_msg': 'file does not exist'})
+
+    def param_list(self, fields):
+        return json.loads(fields['param'])['list']
+
+    # quota
+
+    def on_quota_info(self, state, query, fields):
+        used = sum(len(c) for c in state.files.values())
+        return (200, {'quota': state.quota, 'used': used,
+                      'request_id': 1})
+
+    # file
+
+    def on_file_upload(self, state, query, fields):
+        content = fields.get('file', '')
+        if query.get('type') == 'tmpfile':
+            md5 = hashlib.md5(content).hexdigest()
+            state.blocks[md5] = content
+            return (200, {'md5': md5, 'request_id': 1})
+        path = state.put(query['path'], content, query.get('ondup'))
+        return (200, dict(state.meta(path), request_id=1))
+
+    def on_file_createsuperfile(self, state, query, fields):
+        block_list = json.loads(fields['param'])['block_list']
+        if any(md5 not in state.blocks for md5 in block_list):
+            return (400, {'error_code': 31363,
+                          'error_msg': 'block miss in superfile2'})
+        path = state.put(query['path'],
+                         ''.join(state.blocks[md5] for md5 in block_list),
+                         query.get('ondup'))
+        return (200, dict(state.meta(path), request_id=1))
+
+    def on_file_rapidupload(self, state, query, fields):
+        for path, content in state.files.items():
+            if state.md5s[path] == query['content-md5'] and \
+                    str(len(content)) == query['content-length']:
+                path = state.put(query['path'], content, query.get('ondup'))
+                return (200, dict(state.meta(path), request_id=1))
+        return (404, {'error_code': 31079,
+                      'error_msg': 'file md5 not found'})
+
+    def on_file_download(self, state, query, fields):
+        if query['path'] not in state.files:
+            return self.missing()
+        content = state.files[query['path']]
+        if 'seg' in query:
+            # a segment of the on_file_streaming playlist
+            seg = int(query['seg'])
+            content = content[seg:seg + SEGMENT_SIZE]
+        return self.content(content)
+
+    def content(self, content):
+        span = self.headers.get('Range')
+        if not span:
+            return (200, content, 'application/octet-stream')
+        start, end = span.split('=', 1)[1].split('-')
+        start = int(start)
+        end = min(int(end) if end else len(content) - 1, len(content) - 1)
+        return (206, content[start:end + 1], 'application/octet-stream',
+                {'Content-Range': 'bytes %d-%d/%d' % (start, end,
+                                                      len(content))})
+
+    def on_file_meta(self, state, query, fields):
+        paths = 'param' in fields and \
+            [e['path'] for e in self.param_list(fields)] or [query['path']]
+        if not all(state.exists(p) for p in paths):
+            return self.missing()
+        return (200, {'list': [state.meta(p) for p in paths],
+                      'request_id': 1})
+
+    def on_file_mkdir(self, state, query, fields):
+        if state.exists(query['path']):
+            return (400, {'error_code': 31061,
+                          'error_msg': 'file already exists'})
+        state.mkdirs(query['path'])
+        return (200, dict(state.meta(query['path']), request_id=1))
+
+    def on_file_list(self, state, query, fields):
+        path = query['path']
+        if path not in state.dirs:
+            return self.missing()
+        entries = [state.meta(p) for p in state.children(path)]
+        key = {'time': 'mtime', 'size': 'size'}.get(query.get('by'), 'path')
+        entries.sort(key=lambda e: (-e['isdir'], e[key]),
+                     reverse=query.get('order') == 'desc')
+        if query.get('limit'):
+            start, end = query['limit'].split('-')
+            entries = entries[int(start):int(end)]
+        return (200, {'list': entries, 'request_id': 1})
+
+    def on_file_delete(self, state, query, fields):
+        if query.get('type') == 'recycle':
+            state.recycle.clear()
+            return (200, {'request_id': 1})
+        paths = 'param' in fields and \
+            [e['path'] for e in self.param_list(fields)] or [query['path']]
+        if not all(state.remove(p) for p in paths):
+            return self.missing()
+        return (200, {'request_id': 1})
+
+    def on_file_move(self, state, query, fields, move=True):
+        pairs = 'param' in fields and self.param_list(fields) or \
+            [{'from': query['from'], 'to': query['to']}]
+        for pair in pairs:
+            if not state.copy(pair['from'], pair['to'], move):
+                return self.missing()
+        return (200, {'extra': {'list': pairs}, 'request_id': 1})
+
+    def on_file_copy(self, state, query, fields):
+        return self.on_file_move(state, query, fields, move=False)
+
+    def on_file_search(self, state, query, fields):
+        base = query['path'].rstrip('/')
+        wd = query['wd'].decode('utf-8').lower()
+        found = [state.meta(p) for p in sorted(state.subtree(base))
+                 if p != base and wd in posixpath.basename(p).decode(
+                     'utf-8').lower() and
+                 (query.get('re') == '1' or posixpath.dirname(p) == base)]
+        return (200, {'list': found, 'request_id': 1})
+
+    def on_file_diff(self, state, query, fields):
+        # a cursor is a position in state.log: every path logged since
+        # then is reported as it is now, or as deleted when it is gone
+        reset = query.get('cursor') in (None, 'null')
+        if reset:
+            paths = list(state.files) + list(state.dirs)
+        else:
+            paths = set(state.log[int(query['cursor']):])
+        entries = {}
+        for p in paths:
+            if p == '/':
+                continue
+            if state.exists(p):
+                entries[p] = state.meta(p)
+            else:
+                entries[p] = {'fs_id': state.fs_id(p), 'path': p,
+                              'isdelete': 1}
+        return (200, {'entries': entries,
+                      'has_more': False,
+                      'reset': reset,
+                      'cursor': str(state.changes),
+                      'request_id': 1})
+
+    def on_file_listrecycle(self, state, query, fields):
+        entries = [{'fs_id': fs_id, 'path': path, 'isdir': int(not files),
+                    'size': sum(len(c) for c in files.values())}
+                   for fs_id, (path, files, dirs)
+                   in sorted(state.recycle.items())]
+        start = int(query.get('start', 0))
+        limit = int(query.get('limit', 1000))
+        return (200, {'list': entries[start:start + limit],
+                      'request_id': 1})
+
+    def on_file_restore(self, state, query, fields):
+        ids = 'param' in fields and \
+            [e['fs_id'] for e in self.param_list(fields)] or \
+            [query['fs_id']]
+        for fs_id in ids:
+            path, files, dirs = state.recycle.pop(int(fs_id))
+            for d in dirs:
+                state.mkdirs(d)
+            for p, content in files.items():
+                state.put(p, content)
+        return (200, {'extra': {'list': [{'fs_id': i} for i in ids]},
+                      'request_id': 1})
+
+    # thumbnail
+
+    def on_thumbnail_generate(self, state, query, fields):
+        if query['path'] not in state.files:
+            return self.missing()
+        # not scaled, but stable per (path, size, quality)
+        seed = '%s %s %s %s' % (query['path'], query.get('width'),
+                                query.get('height'), query.get('quality'))
+        return (200, state.files[query['path']][:4096] +
+                hashlib.md5(seed).digest(), 'image/jpeg')
+
+    # stream
+
+    def on_stream_list(self, state, query, fields):
+        suffixes = STREAM_TYPES.get(query.get('type'), ())
+        prefix = query.get('filter_path')
+        entries = [state.meta(p) for p in sorted(state.files)
+                   if p.lower().endswith(suffixes) and
+                   (not prefix or p.startswith(prefix))]
+        start = int(query.get('start', 0))
+        limit = int(query.get('limit', 1000))
+        return (200, {'total': len(entries), 'start': start,
+                      'limit': limit,
+                      'list': entries[start:start + limit]})
+
+    def on_stream_download(self, state, query, fields):
+        return self.on_file_download(state, query, fields)
+
+    def on_file_streaming(self, state, query, fields):
+        if query['path'] not in state.files:
+            return self.missing()
+        playlist = ['#EXTM3U', '#EXT-X-TARGETDURATION:10']
+        size = len(state.files[query['path']])
+        for i in xrange(0, max(size, 1), SEGMENT_SIZE):
+            playlist += ['#EXTINF:10,', '%s?method=download&path=%s&seg=%d'
+                         % (self.server.uri['file'], query['path'], i)]
+        playlist.append('#EXT-X-ENDLIST')
+        return (200, '\n'.join(playlist) + '\n',
+                'application/vnd.apple.mpegurl')
+
+    # cloud_dl
+
+    def on_cloud_dl_add_task(self, state, query, fields):
+        task_id = len(state.tasks) + 1
+        state.tasks[task_id] = {'task_id': str(task_id),
+                                'source_url': query['source_url'],
+                                'save_path': query['save_path'],
+                                'status': '1',
+                                'create_time': str(int(time.time()))}
+        return (200, {'task_id': task_id, 'request_id': 1})
+
+    def on_cloud_dl_query_task(self, state, query, fields):
+        ids = [int(i) for i in query['task_ids'].split(',')]
+        return (200, {'task_info': dict((str(i), state.tasks[i])
+                                        for i in ids if i in state.tasks),
+                      'request_id': 1})
+
+    def on_cloud_dl_list_task(self, state, query, fields):
+        tasks = [state.tasks[i] for i in sorted(state.tasks)]
+        start = int(query.get('start', 0))
+        limit = int(query.get('limit', 10))
+        return (200, {'task_info': tasks[start:start + limit],
+                      'total': len(tasks), 'request_id': 1})
+
+    def on_cloud_dl_cancel_task(self, state, query, fields):
+        state.tasks.pop(int(query['task_id']), None)
+        return (200, {'request_id': 1})
+
+
+class PCSServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0, bandwidth=None, error_rate=0,
+                 error_status=503, address=('127.0.0.1', 0)):
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.state = State()
+        base = 'http://%s:%d/rest/2.0/pcs/' % self.server_address
+        self.uri = dict((name, base + name) for name in ENDPOINTS)
+        self.uri['cloud_dl'] = base + 'services/cloud_dl'
+        self.connections = set()
+        self.lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections.add(request)
+        SocketServer.ThreadingMixIn.process_request(self, request,
+                                                    client_address)
+
+    def shutdown_request(self, request):
+        with self.lock:
+            self.connections.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        self.shutdown()
+        # end idle keep-alive connections too, so no handler thread is
+        # still running when the interpreter exits
+        with self.lock:
+            connections = list(self.connections)
+        for request in connections:
+            try:
+                request.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        deadline = time.time() + timeout
+        while self.connections and time.time() < deadline:
+            time.sleep(0.01)
+        self.server_close()
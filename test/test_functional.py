@@ -3,12 +3,32 @@
 '''
 import unittest
 import baidu.pcs
+import baidu.journal
+import baidu.hashcache
+import baidu.cache
+import baidu.index
+import baidu.coalesce
+import baidu.ratelimit
+import baidu.throttle
+import baidu.tuning
+import baidu.metrics
+import baidu.pcsfs
+import baidu.thumbcache
 import os
 import hashlib
 import tempfile
+import shutil
 import requests
 import datetime
 import time
+import threading
+
+try:
+    import tornado.gen
+    import tornado.ioloop
+    import baidu.aio
+except ImportError:
+    tornado = None
 
 
 def md5sum(filename):
@@ -69,6 +89,27 @@ class TestInfoAPI(unittest.TestCase):
             self.assertTrue(k in r)
         self.assertEqual(code, requests.codes.ok)
 
+    def test_info_limited(self):
+        self.yun.limiter = baidu.ratelimit.RateLimiter(rate=2, burst=1)
+        self.yun.retry = baidu.ratelimit.RetryPolicy()
+        start = time.time()
+        for i in range(3):
+            code, r = self.yun.info()
+            self.assertEqual(code, requests.codes.ok)
+        self.assertTrue(time.time() - start >= 0.9)
+        state = self.yun.limiter.state()['quota']
+        self.assertTrue(state['available'] < 1)
+
+    def test_info_metrics(self):
+        metrics = baidu.metrics.Metrics()
+        self.yun.add_listener(metrics)
+        self.yun.info()
+        text = metrics.prometheus()
+        self.assertTrue('pcs_requests_total{method="info",endpoint="quota",'
+                        'status="200"} 1' in text)
+        self.assertTrue('pcs_request_duration_seconds_count{method="info",'
+                        'endpoint="quota"} 1' in text)
+
 
 class TestUploadAPI(unittest.TestCase):
 
@@ -150,6 +191,49 @@ class TestUploadAPI(unittest.TestCase):
             self.assertTrue(k in r)
         # self.assertEqual(r['md5'], md5sum(filename))
 
+    def test_upload_multi_parallel(self):
+        path = os.environ['APP_FOLDER'] + '/big_test_upload_parallel.jpg'
+        filename = self.test_big_file
+        size = os.path.getsize(filename)
+        chunksize = 1024 * 1024
+        chunks = size / chunksize + (size % chunksize and 1 or 0)
+
+        r = self.yun.upload_multi(filename, chunksize, workers=4)
+        self.assertTrue(type(r) is list and len(r) == chunks)
+        self.assertEqual(r, self.yun.upload_multi(filename, chunksize))
+
+        code, r = self.yun.create_superfile(
+            path=path, file=filename, block_list=r)
+        self.assertEqual(code, requests.codes.ok)
+        self.uploaded.append(r['path'])
+
+    def test_upload_tuned(self):
+        path = os.environ['APP_FOLDER'] + '/big_test_upload_tuned.jpg'
+        self.yun.chunksize = 256 * 1024L
+        self.yun.tuner = baidu.tuning.UploadTuner(max_workers=4)
+        for i in range(2):
+            code, r = self.yun.upload(path=path, file=self.test_big_file)
+            self.assertEqual(code, requests.codes.ok)
+            self.assertTrue(r['tuning']['chunksize'] >= self.yun.chunksize)
+            self.assertTrue(1 <= r['tuning']['workers'] <= 4)
+        self.uploaded.append(r['path'])
+
+    def test_upload_resume(self):
+        path = os.environ['APP_FOLDER'] + '/big_test_upload_resume.jpg'
+        filename = self.test_big_file
+        chunksize = 1024L * 1024
+        self.yun.chunksize = chunksize
+        self.yun.journal = baidu.journal.UploadJournal(tempfile.mkdtemp())
+
+        r = self.yun.upload_multi(filename, chunksize)
+        self.assertEqual(len(self.yun.journal.blocks(filename, chunksize)),
+                         len(r))
+
+        code, r = self.yun.upload(path=path, file=filename)
+        self.assertEqual(code, requests.codes.ok)
+        self.uploaded.append(r['path'])
+        self.assertEqual(self.yun.journal.blocks(filename, chunksize), {})
+
 
 class TestMeta(unittest.TestCase):
 
@@ -189,6 +273,35 @@ class TestMeta(unittest.TestCase):
         self.assertEqual(metas[0]['isdir'], 0)
         self.assertEqual(metas[1]['isdir'], 1)
 
+    def testMetaCache(self):
+        self.yun.cache = baidu.cache.MetaCache(ttl=60)
+        for i in range(3):
+            code, r = self.yun.meta(self.file_path)
+            self.assertEqual(code, requests.codes.ok)
+        self.assertEqual(self.yun.cache.stats()['hits'], 2)
+
+        self.yun.move(self.file_path, self.file_path + '.moved')
+        self.file_path += '.moved'
+        code, r = self.yun.meta(self.file_path[:-len('.moved')])
+        self.assertNotEqual(code, requests.codes.ok)
+
+    def testMetaCoalesced(self):
+        coalescer = baidu.coalesce.Coalescer(self.yun, window=0.5)
+        results = {}
+
+        def meta(path):
+            results[path] = coalescer.meta(path)
+        threads = [threading.Thread(target=meta, args=(p,))
+                   for p in (self.file_path, self.dir_path)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(coalescer.requests, 1)
+        code, r = results[self.dir_path]
+        self.assertEqual(code, requests.codes.ok)
+        self.assertEqual(r['list'][0]['isdir'], 1)
+
 
 class TestReadContent(unittest.TestCase):
 
@@ -241,6 +354,150 @@ class TestReadContent(unittest.TestCase):
         self.assertEqual(md5sum(self.abc_file), md5sum(fn))
         os.remove(fn)
 
+    def testDownloadResume(self):
+        fh, fn = tempfile.mkstemp()
+        self.yun.chunksize = 16
+        self.yun.download(path=self.path, file=fn, resume=True)
+        self.assertEqual(md5sum(self.abc_file), md5sum(fn))
+        self.assertFalse(os.path.exists(fn + '.pcs-state'))
+        os.remove(fn)
+
+    def testOpen(self):
+        f = self.yun.open(self.path, block_size=4)
+        f.seek(3)
+        self.assertEqual(f.read(5), self.content[3:8])
+        self.assertEqual(f.tell(), 8)
+        f.seek(0)
+        self.assertEqual(f.read(), self.content)
+        self.assertTrue(f.requests < len(self.content) / 4)
+
+    def testFileSystem(self):
+        fs = baidu.pcsfs.PCSFileSystem(client=self.yun)
+        self.assertEqual(fs.info(self.path)['size'], len(self.content))
+        self.assertIn(self.path, fs.ls(os.path.dirname(self.path),
+                                       detail=False))
+        self.assertEqual(fs.cat_file(self.path, 1, 4), self.content[1:4])
+        self.assertEqual(
+            fs.cat_ranges([self.path] * 2, [0, 2], [2, None]),
+            [self.content[:2], self.content[2:]])
+
+    def testReadThrottled(self):
+        bandwidth = baidu.throttle.Bandwidth(1024)
+        code, content = self.yun.read(path=self.path, bandwidth=bandwidth)
+        self.assertEqual(content, self.content)
+        self.assertTrue(bandwidth.bucket.available < bandwidth.bucket.burst)
+
+    def testDownloadParallel(self):
+        fh, fn = tempfile.mkstemp()
+        self.yun.chunksize = 16
+        self.yun.download(path=self.path, file=fn, workers=4)
+        self.assertEqual(md5sum(self.abc_file), md5sum(fn))
+        os.remove(fn)
+
+
+class TestDownloadDir(unittest.TestCase):
+
+    def setUp(self):
+        self.yun = baidu.pcs.Client(os.environ['ACCESS_TOKEN'])
+        self.abc_file = os.path.join(os.path.dirname(__file__),
+                                     'res',
+                                     'abc.txt')
+        self.path = os.environ['APP_FOLDER'] + '/' + tmpname('dir_download')
+        self.yun.upload(path=self.path + '/abc.txt', file=self.abc_file)
+        self.yun.upload(path=self.path + '/sub/abc.txt', file=self.abc_file)
+        self.target = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.yun.delete(path=self.path)
+        shutil.rmtree(self.target)
+
+    def testDownloadDir(self):
+        self.yun.chunksize = 16
+        self.yun.download(path=self.path, file=self.target, workers=4)
+        for name in ('abc.txt', os.path.join('sub', 'abc.txt')):
+            self.assertEqual(md5sum(self.abc_file),
+                             md5sum(os.path.join(self.target, name)))
+
+
+class TestUploadTree(unittest.TestCase):
+
+    def setUp(self):
+        self.yun = baidu.pcs.Client(os.environ['ACCESS_TOKEN'])
+        self.abc_file = os.path.join(os.path.dirname(__file__),
+                                     'res',
+                                     'abc.txt')
+        self.path = os.environ['APP_FOLDER'] + '/' + tmpname('tree_upload')
+        self.source = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.source, 'sub'))
+        shutil.copy(self.abc_file, self.source)
+        shutil.copy(self.abc_file, os.path.join(self.source, 'sub'))
+
+    def tearDown(self):
+        self.yun.delete(path=self.path)
+        shutil.rmtree(self.source)
+
+    def test_upload_tree(self):
+        r = self.yun.upload_tree(self.path, self.source, workers=2)
+        self.assertEqual(sorted(r['uploaded']),
+                         [self.path + '/abc.txt', self.path + '/sub/abc.txt'])
+        code, r = self.yun.meta(self.path + '/sub/abc.txt')
+        self.assertEqual(code, requests.codes.ok)
+        r = self.yun.upload_tree(self.path, self.source, workers=2)
+        self.assertEqual(r['uploaded'], [])
+        self.assertEqual(len(r['skipped']), 2)
+
+
+@unittest.skipIf(tornado is None, 'tornado is not installed')
+class TestAsyncClient(unittest.TestCase):
+
+    def setUp(self):
+        self.yun = baidu.aio.AsyncClient(os.environ['ACCESS_TOKEN'])
+        self.loop = tornado.ioloop.IOLoop.current()
+        self.abc_file = os.path.join(os.path.dirname(__file__),
+                                     'res',
+                                     'abc.txt')
+        self.path = os.environ['APP_FOLDER'] + '/abc_async.txt'
+
+    def tearDown(self):
+        self.loop.run_sync(lambda: self.yun.delete(self.path))
+        self.yun.close()
+
+    def test_upload_meta_download(self):
+        code, r = self.loop.run_sync(
+            lambda: self.yun.upload(path=self.path, file=self.abc_file))
+        self.assertEqual(code, requests.codes.ok)
+        self.assertEqual(r['md5'], md5sum(self.abc_file))
+
+        results = self.loop.run_sync(
+            lambda: [self.yun.meta(self.path) for i in range(10)])
+        for code, r in results:
+            self.assertEqual(code, requests.codes.ok)
+            self.assertEqual(r['list'][0]['size'],
+                             os.path.getsize(self.abc_file))
+
+        fh, fn = tempfile.mkstemp()
+        self.loop.run_sync(lambda: self.yun.download(self.path, fn))
+        self.assertEqual(md5sum(self.abc_file), md5sum(fn))
+        os.remove(fn)
+
+    def test_read_stream(self):
+        self.loop.run_sync(
+            lambda: self.yun.upload(path=self.path, file=self.abc_file))
+
+        @tornado.gen.coroutine
+        def read():
+            code, body = yield self.yun.read(self.path, stream=True)
+            chunks = []
+            while True:
+                chunk = yield body.read()
+                if chunk is None:
+                    raise tornado.gen.Return((code, ''.join(chunks)))
+                chunks.append(chunk)
+
+        code, content = self.loop.run_sync(read)
+        self.assertEqual(code, requests.codes.ok)
+        self.assertEqual(content, open(self.abc_file, 'rb').read())
+
 
 class TestMkdir(unittest.TestCase):
 
@@ -288,6 +545,10 @@ class TestList(unittest.TestCase):
         self.assertEqual(c, requests.codes.ok)
         self.assertEqual(len(r['list']), 2)
 
+    def testIterList(self):
+        paths = [e['path'] for e in self.yun.iter_list(self.path, page=2)]
+        self.assertEqual(sorted(paths), sorted(self.files))
+
 
 class TestMoveSingle(unittest.TestCase):
 
@@ -370,6 +631,19 @@ class TestSearch(unittest.TestCase):
         self.assertTrue('list' in r)
         self.assertEqual(code, requests.codes.ok)
 
+    def test_search_local(self):
+        fh, fn = tempfile.mkstemp()
+        index = baidu.index.Index(self.yun, fn)
+        index.sync()
+        found = [e['path'] for e in index.search(self.path, 'abc', re=0)]
+        for f in self.files:
+            self.assertTrue(f in found)
+        found = index.search(self.path, r'^search_abc.*\.txt$', re=1,
+                             regex=True)
+        self.assertTrue(len(found) >= len(self.files))
+        index.close()
+        os.remove(fn)
+
 
 class TestThumbnail(unittest.TestCase):
 
@@ -391,6 +665,19 @@ class TestThumbnail(unittest.TestCase):
         code, r = self.yun.thumbnail(path=self.file, width='480', height='320')
         self.assertEqual(code, requests.codes.ok)
 
+    def test_thumbnail_cached(self):
+        directory = tempfile.mkdtemp()
+        cache = baidu.thumbcache.ThumbnailCache(directory)
+        self.yun.thumbnail_cache = cache
+        code, r = self.yun.meta(self.file)
+        counts = self.yun.prefetch_thumbnails(r['list'], 480, 320)
+        self.assertEqual(counts['fetched'], 1)
+        code, content = self.yun.thumbnail(self.file, 480, 320)
+        self.assertEqual(code, requests.codes.ok)
+        self.assertEqual(cache.hits, 1)
+        cache.close()
+        shutil.rmtree(directory)
+
 
 class TestNoSetup(unittest.TestCase):
 
@@ -444,6 +731,36 @@ class TestNoSetup(unittest.TestCase):
         self.assertTrue(type(r['list']) is list)
 
 
+class TestIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.yun = baidu.pcs.Client(os.environ['ACCESS_TOKEN'])
+        self.abc_file = os.path.join(os.path.dirname(__file__),
+                                     'res',
+                                     'abc.txt')
+        path = os.environ['APP_FOLDER'] + '/' + tmpname('index_') + '.txt'
+        c, r = self.yun.upload(path=path, file=self.abc_file)
+        self.path = r['path']
+        fh, self.db = tempfile.mkstemp()
+        self.index = baidu.index.Index(self.yun, self.db)
+
+    def tearDown(self):
+        self.index.close()
+        os.remove(self.db)
+        self.yun.delete(self.path)
+
+    def test_sync(self):
+        self.assertTrue(self.index.sync() > 0)
+        entry = self.index.stat(self.path)
+        self.assertEqual(entry['size'], os.path.getsize(self.abc_file))
+        self.assertTrue(entry in self.index.listdir(os.environ['APP_FOLDER']))
+
+        self.yun.delete(self.path)
+        time.sleep(1)
+        self.index.sync()
+        self.assertEqual(self.index.stat(self.path), None)
+
+
 class TestStreaming(unittest.TestCase):
 
     def setUp(self):
@@ -468,6 +785,14 @@ class TestStreaming(unittest.TestCase):
         for c in r:
             self.assertTrue(len(c) > 0)
 
+    def test_stream_segments(self):
+        segments = self.yun.stream_segments(self.path, prefetch=3)
+        for content in segments:
+            self.assertTrue(len(content) > 0)
+        self.assertTrue(len(segments.segments) > 0)
+        self.assertTrue(segments.startup > 0)
+        self.assertTrue(segments.received > 0)
+
     def test_stream_download(self):
         code, r = self.yun.stream_download(path=self.path)
         self.assertEqual(code, requests.codes.ok)
@@ -507,6 +832,34 @@ class TestRapidUpload(unittest.TestCase):
 
         self.paths.append(r['path'])
 
+    def test_upload_rapid_first(self):
+        path = os.environ['APP_FOLDER'] + '/rapid_first_clipcanvas.mp4'
+        c, r = self.yun.upload(path, self.video_file, rapid=True)
+        self.assertEqual(c, requests.codes.ok)
+        self.assertEqual(r['strategy'], 'rapid')
+        self.paths.append(r['path'])
+
+        abc_file = os.path.join(os.path.dirname(__file__), 'res', 'abc.txt')
+        path = os.environ['APP_FOLDER'] + '/rapid_first_abc.txt'
+        c, r = self.yun.upload(path, abc_file, rapid=True)
+        self.assertEqual(c, requests.codes.ok)
+        self.assertEqual(r['strategy'], 'single')
+        self.paths.append(r['path'])
+
+    def test_rapid_upload_cached(self):
+        fh, fn = tempfile.mkstemp()
+        self.yun.digest_cache = baidu.hashcache.DigestCache(fn)
+        path = os.environ['APP_FOLDER'] + '/rapid_cached_clipcanvas.mp4'
+        for i in range(2):
+            c, r = self.yun.rapid_upload_file(path, self.video_file)
+            self.assertEqual(c, requests.codes.ok)
+            self.assertEqual(r['md5'], md5sum(self.video_file))
+        self.assertEqual(self.yun.digest_cache.count, 1)
+
+        self.paths.append(r['path'])
+        self.yun.digest_cache.close()
+        os.remove(fn)
+
 
 class TestAddCancelTask(unittest.TestCase):
 